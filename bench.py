@@ -0,0 +1,332 @@
+# Offline benchmark of the taxonomy calculator, synthetic database and portfolios with a fake Eikon backend
+import os
+import time
+import json
+import random
+import hashlib
+import tempfile
+import tracemalloc
+import platform
+import subprocess
+import pandas as pd
+import numpy as np
+from argparse import ArgumentParser
+from openpyxl import Workbook
+import taxo
+
+# eikon column names of the requested fields
+SEGMENT_COLUMNS = {'TR.BGS.BusTotalRevenue.segmentCode': 'Segment Code', 'TR.BGS.BusTotalRevenue.segmentName': 'Segment Name', 'TR.BGS.BusTotalRevenue.fperiod': 'Financial Period Absolute', 'TR.BGS.BusTotalRevenue.currency': 'Currency', 'TR.BGS.BusTotalRevenue.value': 'Business Total Revenues (Calculated)'}
+ESG_COLUMNS = {'TR.CommonName': 'Company Common Name', 'TR.TRESGScore': 'ESG Score', 'TR.TRBCActivityCode': 'TRBC Activity Code', 'TR.TRBCEconomicSector': 'TRBC Economic Sector Name', 'TR.TRBCActivity': 'TRBC Activity Name'}
+DNSH_COLUMNS = {'TR.ControvEnv': 'Environmental Controversies Count', 'TR.RecentControvEnv': 'Recent Environmental Controversies', 'TR.ControvCopyrights': 'Intellectual Property Controversies', 'TR.ControvPublicHealth': 'Public Health Controversies', 'TR.ControvBusinessEthics': 'Business Ethics Controversies', 'TR.ControvTaxFraud': 'Tax Fraud Controversies', 'TR.ControvAntiCompetition': 'Anti-competition Controversy', 'TR.ControvCriticalCountries': 'Critical Countries Controversies', 'TR.RecentControvPublicHealth': 'Recent Public Health Controversies', 'TR.RecentControvBusinessEthics': 'Recent Business Ethics Controversies', 'TR.RecentControvTaxFraud': 'Recent Tax Fraud Controversies', 'TR.RecentControvAntiCompetition': 'Recent Anti-competition Controversy', 'TR.RecentControvCriticalCountries': 'Recent Critical Countries Controversies', 'TR.RecentControvCopyrights': 'Recent Intellectual Property Controversies', 'TR.ControvHumanRights': 'Human Rights Controversies', 'TR.ControvChildLabor': 'Child Labor Controversies', 'TR.RecentControvHumanRights': 'Recent Human Rights Controversies', 'TR.RecentControvChildLabor': 'Recent Child Labor Controversies', 'TR.ControvConsumer': 'Consumer Complaints Controversies Count', 'TR.RecentControvConsumer': 'Recent Consumer Complaints Controversies', 'TR.ControvCustomerHS': 'Customer Health & Safety Controversies', 'TR.ControvResponsibleRD': 'Responsible R&D Controversies', 'TR.ControvPrivacy': 'Privacy Controversies', 'TR.ControvRespMarketing': 'Responsible Marketing Controversies', 'TR.ControvProductAccess': 'Product Access Controversies', 'TR.RecentControvCustomerHS': 'Recent Customer Health & Safety Controversies', 'TR.RecentControvPrivacy': 'Recent Privacy Controversies', 'TR.RecentControvRespMarketing': 'Recent Responsible Marketing Controversies', 'TR.RecentControvProductAccess': 'Recent Product Access Controversies', 'TR.RecentControvResponsibleRD': 'Recent Responsible R&D Controversies', 'TR.Strikes': 'Strikes', 'TR.ControvEmployeesHS': 'Employees Health & Safety Controversies', 'TR.RecentControvEmployeesHS': 'Recent Employees Health & Safety Controversies', 'TR.EnvProducts': 'Environmental Products', 'TR.LandEnvImpactReduction': 'Land Environmental Impact Reduction', 'TR.EcoDesignProducts': 'Eco-Design Products'}
+
+# DNSH fields answered with 'True'/'False' instead of a count
+DNSH_FLAGS = ['TR.Strikes', 'TR.EnvProducts', 'TR.LandEnvImpactReduction', 'TR.EcoDesignProducts']
+
+# bump when the content of the JSON results changes
+RESULTS_VERSION = 1
+
+
+
+#==============================================
+# deterministic stand-in for the eikon module, the same RIC always gets the same data
+class FakeEikon:
+#==============================================
+	def __init__(self, naicsCodes, trbcCodes, measures, seed=0, latency=0.0, maxSegments=8, maxCodes=3):
+		# measures maps the ESG fields of the Testing Metrics sheet to the column name eikon returns for them
+		self.naicsCodes = naicsCodes
+		self.trbcCodes = trbcCodes
+		self.measures = measures
+		self.seed = seed
+		self.latency = latency
+		self.maxSegments = maxSegments
+		self.maxCodes = maxCodes
+		self.calls = []
+
+
+	def rng(self, ric, salt):
+		return random.Random(int(hashlib.md5(('%s|%s|%s' % (self.seed, ric, salt)).encode('utf-8')).hexdigest(), 16))
+
+
+	def get_data(self, instruments, fields, parameters=None):
+		if isinstance(instruments, str):
+			instruments = [instruments]
+		if self.latency > 0:
+			time.sleep(self.latency)
+
+		if fields[0] in SEGMENT_COLUMNS:
+			df = self.segments(instruments, fields)
+		elif fields[0] in DNSH_COLUMNS:
+			df = self.dnsh(instruments, fields)
+		else:
+			df = self.esg(instruments, fields)
+		self.calls.append((len(instruments), len(fields), len(df)))
+		return df, None
+
+
+	def segments(self, instruments, fields):
+		rows = []
+		for ric in instruments:
+			rng = self.rng(ric, 'segments')
+			if rng.random() < 0.05:
+				# no segment data reported
+				rows.append({'Instrument': ric, 'Business Total Revenues (Calculated)': np.nan})
+				continue
+
+			total = 0.
+			for segNo in range(rng.randint(1, self.maxSegments)):
+				codes = [str(rng.choice(self.naicsCodes)) for i in range(rng.randint(1, self.maxCodes))]
+				# 5 digit codes, and segments without a NAICS code
+				codes = [c[:5] if rng.random() < 0.1 else c for c in codes]
+				if rng.random() < 0.05:
+					codes = ['OTHADJ']
+				revenue = rng.uniform(0, 5e9)
+				total += revenue
+				rows.append({'Instrument': ric, 'Segment Code': ','.join(codes), 'Segment Name': 'Segment %i' % segNo, 'Financial Period Absolute': 'FY2021', 'Currency': 'USD', 'Business Total Revenues (Calculated)': revenue})
+			rows.append({'Instrument': ric, 'Segment Code': 'SEGMTL', 'Segment Name': 'Segment Total', 'Financial Period Absolute': 'FY2021', 'Currency': 'USD', 'Business Total Revenues (Calculated)': total})
+			if rng.random() < 0.3:
+				rows.append({'Instrument': ric, 'Segment Code': 'ICELIM', 'Segment Name': 'Eliminations', 'Financial Period Absolute': 'FY2021', 'Currency': 'USD', 'Business Total Revenues (Calculated)': -rng.uniform(0, 1e8)})
+		return pd.DataFrame(rows, columns=['Instrument'] + [SEGMENT_COLUMNS[f] for f in fields])
+
+
+	def esg(self, instruments, fields):
+		columns = ['Instrument'] + [ESG_COLUMNS.get(f, self.measures.get(f, f)) for f in fields]
+		rows = []
+		for ric in instruments:
+			rng = self.rng(ric, 'esg')
+			row = [ric]
+			for f in fields:
+				if f == 'TR.CommonName':
+					row.append('Company %s' % ric)
+				elif f == 'TR.TRESGScore':
+					row.append(rng.uniform(0, 100) if rng.random() < 0.8 else np.nan)
+				elif f == 'TR.TRBCActivityCode':
+					row.append(rng.choice(self.trbcCodes) if rng.random() < 0.9 else np.nan)
+				elif f == 'TR.TRBCEconomicSector':
+					row.append('Sector %i' % rng.randint(1, 10))
+				elif f == 'TR.TRBCActivity':
+					row.append('Activity %i' % rng.randint(1, 100))
+				else:
+					row.append(rng.choice([rng.uniform(0, 100), rng.uniform(0, 100), 0, np.nan]))
+			rows.append(row)
+		return pd.DataFrame(rows, columns=columns)
+
+
+	def dnsh(self, instruments, fields):
+		rows = []
+		for ric in instruments:
+			rng = self.rng(ric, 'dnsh')
+			row = [ric]
+			for f in fields:
+				if f in DNSH_FLAGS:
+					row.append(rng.choice(['True', 'False', 'False', None]))
+				else:
+					row.append(rng.choice([0, 0, 0, 1, 2, np.nan]))
+			rows.append(row)
+		return pd.DataFrame(rows, columns=['Instrument'] + [DNSH_COLUMNS[f] for f in fields])
+
+
+
+#==============================================
+# write a synthetic database.xlsx, returns the NAICS codes, TRBC codes and ESG measures for FakeEikon
+def makeDatabase(dbFileName, nNaics=1000, nTrbc=400, seed=0):
+#==============================================
+	rng = random.Random(seed)
+	naicsCodes = sorted(rng.sample(range(111110, 999990), nNaics))
+	trbcCodes = sorted(rng.sample(range(5010101010, 5999999999), nTrbc))
+	measures = {'TR.BenchMeasure%i' % i: 'Bench Measure %i' % i for i in range(20)}
+
+	workbook = Workbook(write_only=True)
+	sheet = workbook.create_sheet('NAICS>TRBC')
+	sheet.append(['NAICS Code', 'NAICS Title', 'TRBC Hierarchical Code'])
+	for naics in naicsCodes:
+		sheet.append([naics, 'NAICS activity %i' % naics, rng.choice(trbcCodes)])
+
+	sheet = workbook.create_sheet('EU Taxonomy')
+	sheet.append(['TRBC code', 'TRBC Activity', 'Additional testing needed?'])
+	for trbc in trbcCodes:
+		if rng.random() < 0.5:
+			sheet.append([trbc, 'TRBC activity %i' % trbc, rng.choice(['Yes', 'No'])])
+
+	sheet = workbook.create_sheet('Testing Metrics')
+	sheet.append(['TRBC Activity', 'Refinitiv ESG Data Measures', 'Refinitiv ESG Field', 'Used for testing'])
+	for trbc in trbcCodes:
+		if rng.random() < 0.3:
+			field = rng.choice(list(measures))
+			sheet.append([trbc, measures[field], field, rng.uniform(10, 90)])
+	workbook.save(dbFileName)
+
+	return naicsCodes, trbcCodes, measures
+
+
+
+#==============================================
+# write a synthetic input portfolio with a 'RIC' column
+def makePortfolio(pFilename, nRics, seed=0):
+#==============================================
+	rng = random.Random(seed)
+	workbook = Workbook(write_only=True)
+	sheet = workbook.create_sheet('Portfolio')
+	sheet.append(['RIC', 'Name', 'Weight'])
+	for i in range(nRics):
+		# a few delisted instruments
+		ric = 'BENCH%06i.N' % i + ('^L21' if rng.random() < 0.02 else '')
+		sheet.append([ric, 'Company %i' % i, rng.uniform(0, 1)])
+	workbook.save(pFilename)
+
+
+
+#==============================================
+# run one stage, time it and record the peak memory it allocated
+def measure(stages, name, func, *args):
+#==============================================
+	if tracemalloc.is_tracing():
+		tracemalloc.reset_peak()
+	start = time.perf_counter()
+	try:
+		result = func(*args)
+		stages[name] = {'seconds': round(time.perf_counter() - start, 4)}
+	except Exception as e:
+		result = None
+		stages[name] = {'seconds': round(time.perf_counter() - start, 4), 'error': '%s: %s' % (type(e).__name__, e)}
+		print('  %s failed: %s' % (name, stages[name]['error']))
+	if tracemalloc.is_tracing():
+		stages[name]['peakMB'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+	print('  %-28s %9.3f s' % (name, stages[name]['seconds']))
+	return result
+
+
+
+#==============================================
+# benchmark all the stages for one portfolio size
+def runSize(nRics, args, workDir, dbFileName, universe):
+#==============================================
+	pFilename = os.path.join(workDir, 'input_%i.xlsx' % nRics)
+	makePortfolio(pFilename, nRics, args.seed)
+	naicsCodes, trbcCodes, measures = universe
+	fake = FakeEikon(naicsCodes, trbcCodes, measures, args.seed, args.latency, args.max_segments, args.max_codes)
+
+	print('%i instruments' % nRics)
+	stages = {}
+	ricList = measure(stages, 'loadInputPortfolio', taxo.loadInputPortfolio, pFilename)
+	# first load parses the spreadsheet and writes the snapshot, the second one reads the snapshot
+	if os.path.exists(taxo.snapshotName(dbFileName)):
+		os.remove(taxo.snapshotName(dbFileName))
+	measure(stages, 'loadDatabase', taxo.loadDatabase, dbFileName)
+	measure(stages, 'loadDatabase (snapshot)', taxo.loadDatabase, dbFileName)
+
+	fetcher = taxo.DataFetcher(backend=fake, chunkSize=args.chunk_size, workers=args.fetch_workers, rps=0)
+	taxonMaster, esgMaster, dnshMaster = measure(stages, 'getData', taxo.getData, ricList, fetcher)
+	dnshScores = measure(stages, 'scoreDnsh', taxo.scoreDnsh, dnshMaster)
+
+	orgDF = sectorDF = None
+	for engine in args.engines:
+		if engine == 'ric':
+			results = taxo.ResultCollector()
+			measure(stages, 'getTaxoForRic', taxo.scoreRics, ricList, taxonMaster, esgMaster, results)
+			orgDF, sectorDF = results.organizations(), results.segments()
+		else:
+			orgDF, sectorDF = measure(stages, 'scorePortfolio', taxo.scorePortfolio, ricList, taxonMaster, esgMaster) or (None, None)
+
+	if orgDF is not None:
+		# the report name gets a timestamp prefix in the current directory
+		cwd = os.getcwd()
+		os.chdir(workDir)
+		try:
+			for fileFormat in args.formats:
+				name = 'generateReport' if fileFormat == 'xlsx' else 'generateReport (%s)' % fileFormat
+				measure(stages, name, taxo.generateReport, 'bench_report.xlsx', orgDF, sectorDF, dnshScores, [fileFormat])
+		finally:
+			os.chdir(cwd)
+
+	return {
+		'instruments': nRics,
+		'segmentRows': len(taxonMaster),
+		'eikonCalls': len(fake.calls),
+		'stages': stages
+	}
+
+
+
+#==============================================
+# print the stage times of this run against a previous results file
+def compareResults(results, previousFileName):
+#==============================================
+	with open(previousFileName) as f:
+		previous = json.load(f)
+	previousRuns = {run['instruments']: run['stages'] for run in previous['runs']}
+
+	print('\n%-12s %-28s %10s %10s %8s' % ('instruments', 'stage', 'before s', 'now s', 'ratio'))
+	for run in results['runs']:
+		before = previousRuns.get(run['instruments'], {})
+		for name, stage in run['stages'].items():
+			if name in before and before[name]['seconds'] > 0:
+				ratio = stage['seconds'] / before[name]['seconds']
+				print('%-12i %-28s %10.3f %10.3f %7.2fx' % (run['instruments'], name, before[name]['seconds'], stage['seconds'], ratio))
+
+
+
+#==============================================
+def gitRevision():
+#==============================================
+	try:
+		return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True).stdout.strip()
+	except OSError:
+		return ''
+
+
+
+#==============================================
+def main(args):
+#==============================================
+	args.engines = args.engines.split(',')
+	args.formats = args.formats.split(',')
+	if args.memory:
+		tracemalloc.start()
+
+	results = {
+		'version': RESULTS_VERSION,
+		'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+		'revision': gitRevision(),
+		'python': platform.python_version(),
+		'pandas': pd.__version__,
+		'numpy': np.__version__,
+		'config': {k: v for k, v in vars(args).items() if k not in ['output', 'compare', 'keep']},
+		'runs': []
+	}
+	with tempfile.TemporaryDirectory(prefix='taxo_bench_') as tmpDir:
+		workDir = args.keep or tmpDir
+		os.makedirs(workDir, exist_ok=True)
+		dbFileName = os.path.join(workDir, 'database.xlsx')
+		universe = makeDatabase(dbFileName, args.naics, args.trbc, args.seed)
+		for nRics in [int(size) for size in args.sizes.split(',')]:
+			results['runs'].append(runSize(nRics, args, workDir, dbFileName, universe))
+
+	with open(args.output, 'w') as f:
+		json.dump(results, f, indent=2)
+	print('Results written to %s' % args.output)
+
+	if args.compare:
+		compareResults(results, args.compare)
+
+
+
+#==============================================
+if __name__ == "__main__":
+#==============================================
+	parser = ArgumentParser(description='Time each stage of taxo.py on synthetic data, without an Eikon connection')
+	parser.add_argument('--sizes', default='1000,10000', help='Comma separated portfolio sizes (number of RICs)')
+	parser.add_argument('--engines', default='batch,ric', help='Comma separated scoring engines to time: batch (scorePortfolio) and/or ric (getTaxoForRic)')
+	parser.add_argument('--formats', default='xlsx', help='Comma separated report formats to time: xlsx, parquet and/or csv')
+	parser.add_argument('--naics', type=int, default=1000, help='Number of NAICS codes in the synthetic database')
+	parser.add_argument('--trbc', type=int, default=400, help='Number of TRBC codes in the synthetic database')
+	parser.add_argument('--max-segments', type=int, default=8, help='Maximum number of business segments per company')
+	parser.add_argument('--max-codes', type=int, default=3, help='Maximum number of NAICS codes per segment')
+	parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic data')
+	parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every fake Eikon request')
+	parser.add_argument('--chunk-size', type=int, default=500, help='Number of instruments per fake Eikon request')
+	parser.add_argument('--fetch-workers', type=int, default=3, help='Number of concurrent fake Eikon requests')
+	parser.add_argument('--no-memory', dest='memory', action='store_false', help='Do not trace the peak memory of each stage (tracemalloc slows the stages down)')
+	parser.add_argument('-o', '--output', default='bench_results.json', help='JSON file receiving the results')
+	parser.add_argument('--compare', metavar='FILE', help='Results of a previous run to compare against')
+	parser.add_argument('--keep', metavar='DIR', help='Keep the generated files and the report in this directory')
+	main(parser.parse_args())
@@ -1,12 +1,43 @@
 # Taxonomy report generation
-import eikon as ek
 import pandas as pd
+import numpy as np
 import time
+import pickle
+import tempfile
+import threading
+import queue
+import sqlite3
+import hashlib
+import os
+import re
+import json
+import importlib
+import multiprocessing
+import cProfile
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from openpyxl import load_workbook
 from openpyxl import Workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
+from openpyxl.utils import column_index_from_string
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, Color, Alignment, Border, Side, colors, NamedStyle, PatternFill
+try:
+	import eikon as ek
+except ImportError:
+	# a local data backend can still be used without the eikon module
+	ek = None
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	# only needed for parquet portfolios and outputs
+	pa = None
+	pq = None
 
 # global fields
 TRBC_db = None
@@ -14,6 +45,49 @@ TAXON_db = None
 TESTING_MET_db = None
 ESG_FIELDS = None
 
+# segment revenue and DNSH controversy fields requested from Eikon
+SEGMENT_FIELDS = ['TR.BGS.BusTotalRevenue.segmentCode', 'TR.BGS.BusTotalRevenue.segmentName', 'TR.BGS.BusTotalRevenue.fperiod', 'TR.BGS.BusTotalRevenue.currency', 'TR.BGS.BusTotalRevenue.value']
+DNSH_FIELDS = ['TR.ControvEnv','TR.RecentControvEnv','TR.ControvCopyrights','TR.ControvPublicHealth','TR.ControvBusinessEthics','TR.ControvTaxFraud','TR.ControvAntiCompetition','TR.ControvCriticalCountries','TR.RecentControvPublicHealth','TR.RecentControvBusinessEthics','TR.RecentControvTaxFraud','TR.RecentControvAntiCompetition','TR.RecentControvCriticalCountries','TR.RecentControvCopyrights','TR.ControvHumanRights','TR.ControvChildLabor','TR.RecentControvHumanRights','TR.RecentControvChildLabor','TR.ControvConsumer','TR.RecentControvConsumer','TR.ControvCustomerHS','TR.ControvResponsibleRD','TR.ControvPrivacy','TR.ControvRespMarketing','TR.ControvProductAccess','TR.RecentControvCustomerHS','TR.RecentControvPrivacy','TR.RecentControvRespMarketing','TR.RecentControvProductAccess','TR.RecentControvResponsibleRD','TR.Strikes','TR.ControvEmployeesHS','TR.RecentControvEmployeesHS','TR.EnvProducts','TR.LandEnvImpactReduction','TR.EcoDesignProducts']
+
+# DNSH fields answered with 'True'/'False', the other DNSH fields are controversy counts
+DNSH_FLAGS = ['Strikes', 'Environmental Products', 'Land Environmental Impact Reduction', 'Eco-Design Products']
+
+# columns added to the DNSH data by scoreDnsh
+DNSH_SCORE_COLUMNS = ['Environment Controversies', 'Promotes Environmental Products', 'Environment Red Flag', 'Social Controversies']
+
+# segment codes holding totals and adjustments rather than business segments
+SEGMENT_EXCLUDE = 'SEGMTL|ICELIM|EXPOTH|CONSTL'
+
+# long table of the segment codes (SegmentTable.codes): one row per segment and TRBC code, '_seg' is the position of the segment row
+SEGMENT_CODE_DTYPES = {'_seg': 'int64', 'TRBC Code': 'Int64', 'Match': 'category', 'Measure': 'category', 'Reported': object, 'Outcome': 'category', 'Metric': bool}
+SEGMENT_CODE_COLUMNS = list(SEGMENT_CODE_DTYPES)
+
+# organization ratios written to the time series of a multi period run
+TIME_SERIES_COLUMNS = ['Aligned by Industry', 'Additional Testing Required', 'Eligible', 'Not In Scope', 'Others', 'Aligned- Pass', 'Aligned- No Data', 'Aligned- Not in Scope', 'Additional testing needed', 'Total', 'Parent Eligible ratio', 'Parent Not In Scope ratio']
+
+# columns of the organization level results
+ORG_COLUMNS = ['Instrument', 'Name', 'Delisted', 'ESG Score', 'Economic Sector', 'TRBC Activity', 'Aligned by Industry', 'Additional Testing Required', 'Eligible', 'Not In Scope', 'Others', 'Aligned- Pass', 'Aligned- No Data', 'Aligned- Not in Scope', 'Additional testing needed', 'Total', 'Parent Eligible', 'Parent Eligible ratio', 'Parent Not In Scope ratio']
+
+# database loaded by loadDatabase, used when no database is given to the scoring functions
+DATABASE = None
+
+# data shared with the worker processes (scoring shards, manifest reports), inherited on fork
+WORKER_DATA = None
+WORKER_LOCK = threading.Lock()
+
+# bump when the content of the compiled database snapshot changes
+SNAPSHOT_VERSION = 1
+
+# bump when the scoring changes, results stored for incremental rescoring are then recomputed
+STATE_VERSION = 3
+
+# upper bounds (milliseconds) of the per RIC scoring time histogram
+RIC_TIME_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+# Eikon requests and per RIC scoring times kept by RunMetrics (the most recent ones), the totals and the histogram cover all of them
+METRICS_RECENT_CALLS = 1000
+METRICS_RECENT_TIMES = 100000
+
 
 #==============================================
 def init(appkey):
@@ -27,78 +101,625 @@ def init(appkey):
 # load the input portfolio to be analized
 def loadInputPortfolio(pFilename):
 #==============================================
-	workbook = load_workbook(filename = pFilename)
+	inputlist = []
+	for batch in iterInputPortfolio(pFilename):
+		inputlist.extend(batch)
 
-	sheet = workbook.active
-	data = sheet.values
-	cols = next(data)
-	data = list(data)
+	return inputlist
 
-	inputdf = pd.DataFrame(data, columns=cols)
-	inputdf.dropna(inplace=True)
 
-	inputlist = inputdf['RIC'].to_list()
-	inputlist = list(filter(None, inputlist))
 
-	return inputlist
+#==============================================
+# read the input portfolio in batches of unique RICs, only the 'RIC' column of an excel, csv or parquet file is read
+def iterInputPortfolio(pFilename, batchSize=10000):
+#==============================================
+	seen = set()
+	batch = []
+	for ric in readRicColumn(pFilename, batchSize):
+		# blank cells and RICs listed more than once are skipped
+		if ric is None or ric == '' or (isinstance(ric, float) and pd.isnull(ric)) or ric in seen:
+			continue
+		seen.add(ric)
+		batch.append(ric)
+		if len(batch) >= batchSize:
+			yield batch
+			batch = []
+	if batch:
+		yield batch
+
 
 
 #==============================================
-# Load the database from excel spreadsheet
-def loadDatabase(dbFileName):
+# values of the 'RIC' column of a portfolio file, one at a time
+def readRicColumn(pFilename, chunkSize=10000):
 #==============================================
-	global TRBC_db, TAXON_db, TESTING_MET_db, ESG_FIELDS
-	workbook = load_workbook(filename = dbFileName)
+	extension = os.path.splitext(pFilename)[1].lower()
+	if extension == '.csv':
+		for chunk in pd.read_csv(pFilename, usecols=['RIC'], dtype={'RIC': str}, chunksize=chunkSize):
+			yield from chunk['RIC']
+
+	elif extension in ['.parquet', '.pq']:
+		if pq is None:
+			raise ImportError('Reading a parquet portfolio requires the pyarrow module')
+		for recordBatch in pq.ParquetFile(pFilename).iter_batches(batch_size=chunkSize, columns=['RIC']):
+			yield from recordBatch.column(0).to_pylist()
+
+	else:
+		workbook = load_workbook(filename = pFilename, read_only=True)
+		try:
+			sheet = workbook.active
+			cols = next(sheet.iter_rows(max_row=1, values_only=True), ())
+			if 'RIC' not in cols:
+				raise ValueError('%s has no \'RIC\' column-header' % pFilename)
+			ricCol = cols.index('RIC') + 1
+			for row in sheet.iter_rows(min_row=2, min_col=ricCol, max_col=ricCol, values_only=True):
+				yield row[0]
+		finally:
+			workbook.close()
+
+
+#==============================================
+# Load the database into the module globals, from the compiled snapshot when it matches the excel spreadsheet
+def loadDatabase(dbFileName, useSnapshot=True):
+#==============================================
+	global TRBC_db, TAXON_db, TESTING_MET_db, ESG_FIELDS, DATABASE
+	DATABASE = openDatabase(dbFileName, useSnapshot)
+
+	TRBC_db = DATABASE.trbc
+	TAXON_db = DATABASE.taxon
+	TESTING_MET_db = DATABASE.testingMetrics
+	ESG_FIELDS = DATABASE.esgFields
+	return DATABASE
+
 
-	sheet = workbook['NAICS>TRBC']
-	data = sheet.values
-	cols = next(data)
-	data = list(data)
-	TRBC_db = pd.DataFrame(data, columns=cols)
 
-	sheet = workbook['EU Taxonomy']
-	data = sheet.values
-	cols = next(data)
-	data = list(data)
-	TAXON_db = pd.DataFrame(data, columns=cols)
+#==============================================
+# Open the database, from the compiled snapshot when it matches the excel spreadsheet
+def openDatabase(dbFileName, useSnapshot=True):
+#==============================================
+	snapshot = readSnapshot(dbFileName) if useSnapshot else None
+	if snapshot is None:
+		snapshot = compileDatabase(dbFileName, writeSnapshot=useSnapshot)
+	return TaxonomyDatabase(snapshot)
+
+
+
+#==============================================
+# tables, ESG field list and read-only lookup indexes of a loaded database
+class TaxonomyDatabase:
+#==============================================
+	INDEXES = ['naicsTrbcIdx', 'taxonIdx', 'metricIdx']
+
+	def __init__(self, snapshot):
+		self.trbc = snapshot['NAICS>TRBC']
+		self.taxon = snapshot['EU Taxonomy']
+		self.testingMetrics = snapshot['Testing Metrics']
+		self.esgFields = list(snapshot['ESG_FIELDS'])
+		self.naicsTrbcIdx = MappingProxyType(snapshot['NAICS_TRBC_IDX'])
+		self.taxonIdx = MappingProxyType(snapshot['TAXON_IDX'])
+		self.metricIdx = MappingProxyType(snapshot['METRIC_IDX'])
+
+
+	def __getstate__(self):
+		# mapping proxies cannot be pickled, spawned workers get the plain dictionaries
+		state = dict(self.__dict__)
+		for name in self.INDEXES:
+			state[name] = dict(state[name])
+		return state
+
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		for name in self.INDEXES:
+			setattr(self, name, MappingProxyType(state[name]))
+
 
-	sheet = workbook['Testing Metrics']
-	data = sheet.values
-	cols = next(data)
-	data = list(data)
-	TESTING_MET_db = pd.DataFrame(data, columns=cols)
+
+#==============================================
+# Parse the excel spreadsheet database into tables, ESG field list and lookup indexes
+def compileDatabase(dbFileName, writeSnapshot=True):
+#==============================================
+	snapshot = {'version': SNAPSHOT_VERSION, 'hash': fileDigest(dbFileName)}
+	workbook = load_workbook(filename = dbFileName)
+
+	for sheetName in ['NAICS>TRBC', 'EU Taxonomy', 'Testing Metrics']:
+		sheet = workbook[sheetName]
+		data = sheet.values
+		cols = next(data)
+		data = list(data)
+		snapshot[sheetName] = pd.DataFrame(data, columns=cols)
 
 	# get all the unique ESG fields from the database
-	ESG_FIELDS = list(set(TESTING_MET_db['Refinitiv ESG Field'].to_list()))
-	if None in ESG_FIELDS:
-		ESG_FIELDS.remove(None)
+	testingMetDB = snapshot['Testing Metrics']
+	esgFields = sorted(set(testingMetDB['Refinitiv ESG Field'].dropna().to_list()))
+
+	esgFields.append('TR.CommonName')
+	esgFields.append('TR.TRESGScore')
+	esgFields.append('TR.TRBCActivityCode')
+	esgFields.append('TR.TRBCEconomicSector')
+	esgFields.append('TR.TRBCActivity')
+	snapshot['ESG_FIELDS'] = esgFields
+
+	# build the lookup indexes
+	snapshot['NAICS_TRBC_IDX'], snapshot['TAXON_IDX'], snapshot['METRIC_IDX'] = buildIndexes(snapshot['NAICS>TRBC'], snapshot['EU Taxonomy'], testingMetDB)
+
+	if writeSnapshot:
+		try:
+			with open(snapshotName(dbFileName), 'wb') as f:
+				pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+		except OSError as e:
+			print('Warning: Unable to write database snapshot: %s' % e)
+
+	return snapshot
+
+
+
+#==============================================
+# Read the compiled database, None when it is missing or the excel spreadsheet has changed
+def readSnapshot(dbFileName):
+#==============================================
+	try:
+		with open(snapshotName(dbFileName), 'rb') as f:
+			snapshot = pickle.load(f)
+	except Exception:
+		# missing, or written by an incompatible pandas version
+		return None
+
+	if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('hash') != fileDigest(dbFileName):
+		return None
+	return snapshot
+
+
+
+#==============================================
+def snapshotName(dbFileName):
+#==============================================
+	return dbFileName + '.snapshot'
+
+
+
+#==============================================
+# sha256 of a file content
+def fileDigest(fileName):
+#==============================================
+	digest = hashlib.sha256()
+	with open(fileName, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+
+#==============================================
+# normalize a NAICS segment code into the integer key used by the NAICS>TRBC table
+def naicsKey(naicCode):
+#==============================================
+	# append 0 if the code is < 6 chars
+	if len(naicCode) < 6:
+		naicCode = naicCode + '0'
+	return int(naicCode)
+
+
+
+#==============================================
+# build dictionary indexes for the database tables, first matching row wins
+def buildIndexes(trbcDB, taxonDB, testingMetDB):
+#==============================================
+	naicsIdx = {}
+	for naics, trbc in zip(trbcDB['NAICS Code'], trbcDB['TRBC Hierarchical Code']):
+		naicsIdx.setdefault(naics, trbc)
+
+	taxonIdx = {}
+	for trbc, needed in zip(taxonDB['TRBC code'], taxonDB['Additional testing needed?']):
+		taxonIdx.setdefault(trbc, needed)
+
+	metricIdx = {}
+	for trbc, measure, field, threshold in zip(testingMetDB['TRBC Activity'], testingMetDB['Refinitiv ESG Data Measures'], testingMetDB['Refinitiv ESG Field'], testingMetDB['Used for testing']):
+		metricIdx.setdefault(trbc, (measure, field, threshold))
+
+	return naicsIdx, taxonIdx, metricIdx
+
+
+
+#==============================================
+# stage timers, Eikon request statistics and per RIC scoring times of a run
+class RunMetrics:
+#==============================================
+	def __init__(self, recentCalls=METRICS_RECENT_CALLS, recentTimes=METRICS_RECENT_TIMES):
+		# bounded, a service records requests for as long as it runs
+		self.lock = threading.Lock()
+		self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+		self.stages = {}
+		self.groups = {}
+		self.calls = deque(maxlen=recentCalls)
+		self.cached = {}
+		self.ricTimes = deque(maxlen=recentTimes)
+		self.ricCounts = np.zeros(len(RIC_TIME_BUCKETS) + 1, dtype=np.int64)
+		self.ricSeconds = 0.
+		self.ricMax = 0.
+		self.timedInstruments = 0
+		self.instruments = 0
+		self.reused = 0
+
+
+	@contextmanager
+	def stage(self, name):
+		# seconds spent in the block, added to the stage total (a stage may run several times, e.g. in service mode)
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			with self.lock:
+				self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+
+	def addCall(self, group, instruments, seconds, df, err):
+		call = {'group': group, 'instruments': instruments, 'seconds': round(seconds, 4), 'rows': 0, 'bytes': 0}
+		if df is not None:
+			call['rows'] = len(df)
+			call['bytes'] = int(df.memory_usage(index=False, deep=True).sum())
+		if err:
+			call['error'] = str(err)
+		with self.lock:
+			self.calls.append(call)
+			totals = self.groups.setdefault(group, {'calls': 0, 'errors': 0, 'instruments': 0, 'rows': 0, 'bytes': 0, 'seconds': 0., 'maxSeconds': 0.})
+			totals['calls'] += 1
+			totals['errors'] += 'error' in call
+			totals['instruments'] += instruments
+			totals['rows'] += call['rows']
+			totals['bytes'] += call['bytes']
+			totals['seconds'] += seconds
+			totals['maxSeconds'] = max(totals['maxSeconds'], call['seconds'])
+
+
+	def addCached(self, group, instruments):
+		with self.lock:
+			self.cached[group] = self.cached.get(group, 0) + instruments
+
+
+	def addRics(self, times):
+		if len(times) == 0:
+			return
+		times = np.asarray(times, dtype=float)
+		counts = np.bincount(np.searchsorted(RIC_TIME_BUCKETS, times * 1000), minlength=len(RIC_TIME_BUCKETS) + 1)
+		with self.lock:
+			self.ricTimes.extend(times.tolist())
+			self.ricCounts += counts
+			self.ricSeconds += times.sum()
+			self.ricMax = max(self.ricMax, times.max())
+			self.timedInstruments += len(times)
+
+
+	def addInstruments(self, instruments, reused=0):
+		with self.lock:
+			self.instruments += instruments
+			self.reused += reused
+
+
+	def summary(self):
+		# the request list and the percentiles cover the most recent requests and scoring times, the other figures the whole run
+		with self.lock:
+			calls = list(self.calls)
+			groups = {name: dict(totals, seconds=round(totals['seconds'], 4)) for name, totals in self.groups.items()}
+			for name, instruments in self.cached.items():
+				groups.setdefault(name, {})['cachedInstruments'] = instruments
+			ricTimes = np.array(self.ricTimes)
+			timed, ricSeconds, ricMax, ricCounts = self.timedInstruments, self.ricSeconds, self.ricMax, self.ricCounts.tolist()
+			summary = {'started': self.started, 'instruments': self.instruments, 'reused': self.reused, 'stages': {name: round(sec, 4) for name, sec in self.stages.items()}}
+		summary['eikon'] = {'groups': groups, 'requests': calls}
+
+		scoring = {'timedInstruments': timed}
+		if timed:
+			scoring['meanMs'] = round(ricSeconds * 1000 / timed, 3)
+			for q in [50, 90, 99]:
+				scoring['p%iMs' % q] = round(np.percentile(ricTimes, q) * 1000, 3)
+			scoring['maxMs'] = round(ricMax * 1000, 3)
+			# number of instruments per scoring time bucket
+			labels = ['<=%ims' % b for b in RIC_TIME_BUCKETS] + ['>%ims' % RIC_TIME_BUCKETS[-1]]
+			scoring['histogram'] = dict(zip(labels, ricCounts))
+		elif summary['instruments'] and 'scoring' in summary['stages']:
+			# the batch engine scores the portfolio at once, only the average is known
+			scoring['meanMs'] = round(summary['stages']['scoring'] * 1000 / summary['instruments'], 3)
+			scoring['note'] = 'scored in one pass, the histogram needs --engine ric'
+		summary['scoring'] = scoring
+		return summary
+
+
+	def write(self, fileName, extra=None):
+		summary = self.summary()
+		summary.update(extra or {})
+		try:
+			with open(fileName, 'w') as f:
+				json.dump(summary, f, indent=2)
+		except OSError as e:
+			print('Warning: Unable to write the run metrics: %s' % e)
+
+
+
+#==============================================
+# spaces out the requests to stay within a requests per second budget
+class RateLimiter:
+#==============================================
+	def __init__(self, rps):
+		self.interval = 1.0 / rps if rps > 0 else 0
+		self.lock = threading.Lock()
+		self.nextSlot = 0
+
+
+	def wait(self):
+		if self.interval == 0:
+			return
+		with self.lock:
+			now = time.monotonic()
+			slot = max(now, self.nextSlot)
+			self.nextSlot = slot + self.interval
+		if slot > now:
+			time.sleep(slot - now)
+
+
+
+#==============================================
+# local cache of the Eikon responses, keyed by instrument, field list and as-of date
+class DataCache:
+#==============================================
+	def __init__(self, fileName, ttl=24 * 3600, maxEntries=100000):
+		# ttl in seconds, maxEntries is the number of (instrument, field list, as-of) responses kept, least recently used go first
+		self.ttl = ttl
+		self.maxEntries = maxEntries
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(fileName, check_same_thread=False)
+		self.db.execute('CREATE TABLE IF NOT EXISTS responses (fieldKey TEXT, asOf TEXT, ric TEXT, fetched REAL, accessed REAL, data BLOB, PRIMARY KEY (fieldKey, asOf, ric))')
+		self.db.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+		self.db.commit()
+
+
+	@staticmethod
+	def fieldKey(fields):
+		return hashlib.sha1('|'.join(sorted(fields)).encode('utf-8')).hexdigest()
+
+
+	def get(self, rics, fields, asOf='', expired=False):
+		# returns the cached frames and the list of instruments which are missing or expired, expired also returns the entries older than the ttl
+		key = self.fieldKey(fields)
+		now = time.time()
+		rics = list(dict.fromkeys(rics))
+		found = {}
+		with self.lock:
+			for i in range(0, len(rics), 500):
+				part = rics[i:i + 500]
+				query = 'SELECT ric, fetched, data FROM responses WHERE fieldKey = ? AND asOf = ? AND ric IN (%s)' % ','.join('?' * len(part))
+				for ric, fetched, data in self.db.execute(query, [key, asOf] + part):
+					if expired or now - fetched <= self.ttl:
+						found[ric] = data
+			self.db.executemany('UPDATE responses SET accessed = ? WHERE fieldKey = ? AND asOf = ? AND ric = ?', [(now, key, asOf, ric) for ric in found])
+			self.db.commit()
+
+		# rebuild one frame per column layout
+		layouts = {}
+		for ric in rics:
+			if ric in found:
+				columns, rows = pickle.loads(found[ric])
+				layouts.setdefault(columns, []).extend(rows)
+		frames = [pd.DataFrame(rows, columns=list(columns)) for columns, rows in layouts.items()]
+		return frames, [ric for ric in rics if ric not in found]
+
+
+	def put(self, df, rics, fields, asOf=''):
+		# stores the rows of df for each of the requested instruments, instruments without rows are cached as empty
+		key = self.fieldKey(fields)
+		now = time.time()
+		columns = tuple(df.columns)
+		rowsByRic = {ric: [] for ric in rics}
+		if 'Instrument' in columns:
+			instrPos = columns.index('Instrument')
+			for row in df.itertuples(index=False, name=None):
+				if row[instrPos] in rowsByRic:
+					rowsByRic[row[instrPos]].append(row)
+		entries = [(key, asOf, ric, now, now, pickle.dumps((columns, rows), protocol=pickle.HIGHEST_PROTOCOL)) for ric, rows in rowsByRic.items()]
+		with self.lock:
+			self.db.executemany('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)', entries)
+			self.db.commit()
+
+
+	def evict(self):
+		with self.lock:
+			self.db.execute('DELETE FROM responses WHERE fetched < ?', (time.time() - self.ttl,))
+			self.db.execute('DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (self.maxEntries,))
+			self.db.commit()
+
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+
+
+#==============================================
+# fetches field groups for a list of instruments in chunks, concurrently
+class DataFetcher:
+#==============================================
+	def __init__(self, backend=None, chunkSize=500, workers=3, retries=3, backoff=1.0, rps=5, cache=None, offline=False, refresh=False, asOf='', metrics=None):
+		# backend is any object with an eikon style get_data(instruments, fields) -> (DataFrame, err), default is the eikon module
+		self.backend = backend
+		self.chunkSize = chunkSize
+		self.workers = workers
+		self.retries = retries
+		self.backoff = backoff
+		self.limiter = RateLimiter(rps)
+		# optional DataCache, offline only reads from the cache (expired entries included, nothing is evicted), refresh ignores the cached entries
+		self.cache = cache
+		self.offline = offline
+		self.refresh = refresh
+		self.asOf = asOf
+		# (group, chunk number, error) for every chunk which reported an error
+		self.errors = []
+		# optional RunMetrics receiving the time, rows and size of every request
+		self.metrics = metrics
+
+
+	def getFields(self, inputlist, fieldGroups):
+		# fieldGroups maps a group name to its field list, returns a frame per group in the order of inputlist
+		return self.getPeriodFields(inputlist, fieldGroups, [None])[None]
+
+
+	def getPeriodFields(self, inputlist, fieldGroups, periods):
+		# returns {period: {group: frame}}, the requests of all the periods share the pool and the rate limit
+		# a period is a fiscal period or an as-of date (see periodParameters), None for the latest data
+		requests = [(period, name, fields) for period in periods for name, fields in fieldGroups.items()]
+		cached = {}
+		toFetch = {}
+		for period, name, fields in requests:
+			if self.cache is not None and not self.refresh:
+				cached[period, name], toFetch[period, name] = self.cache.get(inputlist, fields, self.periodKey(period), expired=self.offline)
+			else:
+				cached[period, name], toFetch[period, name] = [], inputlist
+			if self.offline:
+				toFetch[period, name] = []
+			if self.metrics is not None and self.cache is not None:
+				self.metrics.addCached(groupName(name, period), len(set(inputlist)) - len(toFetch[period, name]))
+
+		jobs = []
+		for period, name, fields in requests:
+			rics = toFetch[period, name]
+			chunks = [rics[i:i + self.chunkSize] for i in range(0, len(rics), self.chunkSize)]
+			jobs += [(period, name, chunkNo, chunk, fields) for chunkNo, chunk in enumerate(chunks)]
+		with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+			results = list(pool.map(lambda job: self.fetchChunk(groupName(job[1], job[0]), *job[2:], periodParameters(job[0])), jobs))
+
+		# the chunks received are cached before a failed one is reported, the next run only requests the others
+		fetched = {}
+		failed = []
+		for (period, name, chunkNo, chunk, fields), df in zip(jobs, results):
+			if df is None:
+				failed.append((groupName(name, period), chunk))
+				continue
+			if self.cache is not None:
+				self.cache.put(df, chunk, fields, self.periodKey(period))
+			fetched.setdefault((period, name), []).append(df)
+		if self.cache is not None and not self.offline:
+			self.cache.evict()
+		if failed:
+			# the instruments of a failed chunk would be scored as if they had no data
+			rics = [ric for name, chunk in failed for ric in chunk]
+			raise RuntimeError('%s data request(s) failed after %i retries for [%s] instruments: %s ...' % (', '.join(dict.fromkeys(name for name, chunk in failed)), self.retries, len(rics), rics[0:4]))
+
+		frames = {period: {} for period in periods}
+		for period, name, fields in requests:
+			parts = cached[period, name] + fetched.get((period, name), [])
+			frame = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=['Instrument'])
+			if cached[period, name]:
+				# cached and fetched rows are mixed, restore the input order
+				position = {}
+				for i, ric in enumerate(inputlist):
+					position.setdefault(ric, i)
+				frame = frame.iloc[frame['Instrument'].map(position).argsort(kind='stable')].reset_index(drop=True)
+			frames[period][name] = frame
+		return frames
+
+
+	def periodKey(self, period):
+		# as-of key of the cached responses of a period
+		return self.asOf if period is None else '%s|%s' % (self.asOf, period)
+
+
+	def fetchChunk(self, name, chunkNo, chunk, fields, parameters=None):
+		backend = self.backend if self.backend is not None else ek
+		for attempt in range(self.retries + 1):
+			self.limiter.wait()
+			start = time.perf_counter()
+			try:
+				if parameters:
+					df, err = backend.get_data(chunk, fields, parameters=parameters)
+				else:
+					df, err = backend.get_data(chunk, fields)
+			except Exception as e:
+				self.recordCall(name, chunk, start, None, e)
+				if attempt < self.retries:
+					time.sleep(self.backoff * 2 ** attempt)
+					continue
+				self.reportError(name, chunkNo, chunk, e)
+				return None
+			self.recordCall(name, chunk, start, df, err)
+			if err:
+				# partial errors (e.g. a field not available for some instruments), the data is still usable
+				self.reportError(name, chunkNo, chunk, err)
+			return df
+
+
+	def recordCall(self, name, chunk, start, df, err):
+		if self.metrics is not None:
+			self.metrics.addCall(name, len(chunk), time.perf_counter() - start, df, err)
+
 
-	ESG_FIELDS.append('TR.CommonName')
-	ESG_FIELDS.append('TR.TRESGScore')
-	ESG_FIELDS.append('TR.TRBCActivityCode')
-	ESG_FIELDS.append('TR.TRBCEconomicSector')
-	ESG_FIELDS.append('TR.TRBCActivity')
+	def reportError(self, name, chunkNo, chunk, err):
+		self.errors.append((name, chunkNo, err))
+		print('Warning: %s data, chunk %i (%s ... %s): %s' % (name, chunkNo, chunk[0], chunk[-1], err))
+
+
+
+#==============================================
+# get_data parameters of a period: a yyyy-mm-dd date is an as-of date, anything else a fiscal period (FY2020, FY0, FY-1)
+def periodParameters(period):
+#==============================================
+	if period is None:
+		return None
+	if re.fullmatch(r'\d{4}-\d{2}-\d{2}', period):
+		return {'SDate': period}
+	return {'Period': period}
+
+
+
+#==============================================
+# request group name used in the metrics and warnings, with its period
+def groupName(name, period):
+#==============================================
+	return name if period is None else '%s %s' % (name, period)
+
+
+
+#==============================================
+# list of periods from a comma separated list of fiscal periods and/or an as-of date range START:END (yearly dates from START)
+def expandPeriods(periods=None, dateRange=None):
+#==============================================
+	result = [p.strip() for p in periods.split(',') if p.strip()] if periods else []
+	if dateRange:
+		bounds = dateRange.split(':')
+		if len(bounds) != 2:
+			raise ValueError('Date range must be START:END, e.g. 2019-12-31:2021-12-31')
+		start, end = pd.Timestamp(bounds[0]), pd.Timestamp(bounds[1])
+		if end < start:
+			raise ValueError('Date range END %s is before START %s' % (bounds[1], bounds[0]))
+		years = 0
+		while start + pd.DateOffset(years=years) <= end:
+			result.append((start + pd.DateOffset(years=years)).strftime('%Y-%m-%d'))
+			years += 1
+	if not result:
+		raise ValueError('No period to score in the periods %r' % periods)
+	return list(dict.fromkeys(result))
 
 
 
 #==============================================
 # Get the taxonomy data for a RICs from Eikon/RDP
-def getData(inputlist):
+def getData(inputlist, fetcher=None, db=None):
 #==============================================
-	# get sector revenue data
-	txk, err = ek.get_data(inputlist, ['TR.BGS.BusTotalRevenue.segmentCode', 'TR.BGS.BusTotalRevenue.segmentName', 'TR.BGS.BusTotalRevenue.fperiod', 'TR.BGS.BusTotalRevenue.currency', 'TR.BGS.BusTotalRevenue.value'])
-	# also get the ESG data for all the fields
-	esg_f, err = ek.get_data(inputlist, ESG_FIELDS)
-	dnsh, err = ek.get_data(inputlist, ['TR.ControvEnv','TR.RecentControvEnv','TR.ControvCopyrights','TR.ControvPublicHealth','TR.ControvBusinessEthics','TR.ControvTaxFraud','TR.ControvAntiCompetition','TR.ControvCriticalCountries','TR.RecentControvPublicHealth','TR.RecentControvBusinessEthics','TR.RecentControvTaxFraud','TR.RecentControvAntiCompetition','TR.RecentControvCriticalCountries','TR.RecentControvCopyrights','TR.ControvHumanRights','TR.ControvChildLabor','TR.RecentControvHumanRights','TR.RecentControvChildLabor','TR.ControvConsumer','TR.RecentControvConsumer','TR.ControvCustomerHS','TR.ControvResponsibleRD','TR.ControvPrivacy','TR.ControvRespMarketing','TR.ControvProductAccess','TR.RecentControvCustomerHS','TR.RecentControvPrivacy','TR.RecentControvRespMarketing','TR.RecentControvProductAccess','TR.RecentControvResponsibleRD','TR.Strikes','TR.ControvEmployeesHS','TR.RecentControvEmployeesHS','TR.EnvProducts','TR.LandEnvImpactReduction','TR.EcoDesignProducts'])
+	if fetcher is None:
+		fetcher = DataFetcher()
+	if db is None:
+		db = DATABASE
+	# get sector revenue data, the ESG data for all the fields and the DNSH controversies
+	frames = fetcher.getFields(inputlist, {'Segment': SEGMENT_FIELDS, 'ESG': db.esgFields, 'DNSH': DNSH_FIELDS})
 
-	return txk, esg_f, dnsh
+	return frames['Segment'], frames['ESG'], frames['DNSH']
 
 
 
 #==============================================
 # handle case when no data is available for a RIC
-def processEmpty(ric, buisData, esgData):
+def processEmpty(ric, buisData, esgData, db=None):
 #==============================================
+	if db is None:
+		db = DATABASE
 	aggD = {
 		'Instrument': ric,
 		'Name': esgData['Company Common Name'][0],
@@ -112,32 +733,33 @@ def processEmpty(ric, buisData, esgData):
 	#-----------------------------------
 	parentTRBCode = esgData['TRBC Activity Code'][0]
 	if not pd.isnull(parentTRBCode):
-		parentTxnMatch = TAXON_db[TAXON_db['TRBC code'] == parentTRBCode]
-		if parentTxnMatch.empty:
+		if parentTRBCode not in db.taxonIdx:
 			aggD['Parent Eligible'] = 'Not in scope'
 			aggD['Parent Not In Scope ratio'] = 1
 		else:
-			aggD['Parent Eligible'] = parentTxnMatch.iloc[0]['Additional testing needed?']
+			aggD['Parent Eligible'] = db.taxonIdx[parentTRBCode]
 			aggD['Parent Eligible ratio'] = 1
 
 	buisData['Name'] = esgData['Company Common Name'][0]
 	buisData['Delisted'] = 'Delisted, No Data' if '^' in ric else 'No Data'
-	return aggD, buisData
+	return aggD, SegmentTable(buisData.reset_index(drop=True))
 
 
 
 #==============================================
 # process taxonomy data for single RIC
-def getTaxoForRic(ric, buisData, esgData):
+def getTaxoForRic(ric, buisData, esgData, db=None):
 #==============================================
+	if db is None:
+		db = DATABASE
 	if pd.isnull(buisData['Business Total Revenues (Calculated)'][0]):
-		return processEmpty(ric, buisData, esgData)
+		return processEmpty(ric, buisData, esgData, db)
 
-	# Step 3: Calculate the segment revenue share
-	txkSeg = pd.DataFrame(buisData[~buisData['Segment Code'].str.match('SEGMTL|ICELIM|EXPOTH|CONSTL')])
+	# Step 3: Calculate the segment revenue share, the rows are labelled by position for .at[]
+	txkSeg = pd.DataFrame(buisData[~buisData['Segment Code'].str.match(SEGMENT_EXCLUDE)]).reset_index(drop=True)
 	revList = txkSeg['Business Total Revenues (Calculated)'].to_list()
 	if sum(revList) < 10:
-		return processEmpty(ric, buisData, esgData)
+		return processEmpty(ric, buisData, esgData, db)
 		
 	segRevenueRatio = [x/sum(revList) for x in revList]
 	#print('Segment revenue ratio: %s' % segRevenueRatio)
@@ -146,12 +768,7 @@ def getTaxoForRic(ric, buisData, esgData):
 	txkSeg.insert(1, 'Name', esgData['Company Common Name'][0])
 	txkSeg.insert(2, 'Delisted', 'Delisted' if '^' in ric else '')
 	txkSeg['Segment Revenue Ratio'] = segRevenueRatio
-	txkSeg['TRBC Codes'] = ''
-	txkSeg['Match with EU Taxo'] = ''
-	txkSeg['Linked Assesment Metric'] = ''
-	txkSeg['Metric Reported Value'] = ''
-	txkSeg['Threshold Test'] = ''
-	txkSeg['Segment Weight'] = ''
+	txkSeg['Segment Weight'] = pd.Series('', index=txkSeg.index, dtype=object)
 
 	txkSeg['Aligned'] = 0.
 	txkSeg['Additional Testing Required'] = 0.
@@ -161,6 +778,8 @@ def getTaxoForRic(ric, buisData, esgData):
 	txkSeg['Aligned- No Data'] = 0.
 	txkSeg['Aligned- Not in Scope'] = 0.
 
+	# one row per segment and TRBC code, joined into text only in the report
+	codeRows = []
 	for idx in range(len(txkSeg)):
 
 		# Step 5: Convert NAICS code to TRBC codes for every segment
@@ -169,94 +788,66 @@ def getTaxoForRic(ric, buisData, esgData):
 		trbcCodeList = []
 		for naicCode in segCodeList:
 			if(naicCode.isnumeric()):
-				# append 0 if the code is < 6 chars
-				if len(naicCode) < 6:
-					naicCode = naicCode + '0'
 				# lookup the NIACS -> TRBC code
-				trbMatch = TRBC_db[TRBC_db['NAICS Code'] == int(naicCode)]
-				if trbMatch.empty:
-					trbcCodeList.append(0)
-				else:
-					trbcCodeList.append(trbMatch.iloc[0]['TRBC Hierarchical Code'])
+				trbcCodeList.append(db.naicsTrbcIdx.get(naicsKey(naicCode), 0))
 
 		#print('%i: NAICS: %s, TRBC: %s' % (idx, segCodeList, trbcCodeList))
-		txkSeg.at[idx, 'TRBC Codes'] = ', '.join(str(e) for e in trbcCodeList)
 
 
 		# Step 6: match against EU taxonomy
 		#-----------------------------------
 		matchAgainstTaxo = []
 		for tCode in trbcCodeList:
-			txnMatch = TAXON_db[TAXON_db['TRBC code'] == tCode]
-			if txnMatch.empty:
-				matchAgainstTaxo.append('na')
-			else:
-				matchAgainstTaxo.append(txnMatch.iloc[0]['Additional testing needed?'])
+			matchAgainstTaxo.append(db.taxonIdx.get(tCode, 'na'))
 
 		#print('%i: Matching with EU Taxonomy: %s' % (idx, matchAgainstTaxo))
-		txkSeg.at[idx, 'Match with EU Taxo'] = ', '.join(str(e) for e in matchAgainstTaxo)
 
 
 		# Step 7: Is TRBC Code aligned to assesement metric
 		#-----------------------------------
 		alignedMetricName = []
 		alignedMetricField = []
+		threasoldValues = []
+		hasMetric = []
 		for tCode in trbcCodeList:
-			metMatch = TESTING_MET_db[TESTING_MET_db['TRBC Activity'] == tCode]
-			if not metMatch.empty:
-				alignedMetricName.append(metMatch.iloc[0]['Refinitiv ESG Data Measures'])
-				alignedMetricField.append(metMatch.iloc[0]['Refinitiv ESG Field'])
+			metMatch = db.metricIdx.get(tCode)
+			hasMetric.append(metMatch is not None)
+			if metMatch is not None:
+				alignedMetricName.append(metMatch[0])
+				alignedMetricField.append(metMatch[1])
+				threasoldValues.append(metMatch[2])
 			else:
 				alignedMetricName.append('')
+				threasoldValues.append('')
 
 		#print('Is business segment aligned: %s' % alignedMetricName)
-		if not all('' == s for s in alignedMetricName):
-			txkSeg.at[idx, 'Linked Assesment Metric'] = ', '.join(str(e) for e in alignedMetricName)
-
 		alignedMetricField = list(set(alignedMetricField))
 		#print('ESG fields used: %s' % alignedMetricField)
 
 
 		# Step 8: What is company reported value for aligned metric
 		#-----------------------------------
-		if len(alignedMetricField) > 0:
-			repValues = []
-			for almn in alignedMetricName:
-				if almn in esgData.columns:
-					repValues.append(esgData[almn][0])
-				else:
-					repValues.append('')
-
-			#print('Reported values: %s' % repValues)
-			#if not all(pd.isna(s) or '' == s for s in repValues):
-			txkSeg.at[idx, 'Metric Reported Value'] = ', '.join(str(e) for e in repValues)
-
-			# Step 9: Does it pass threashold test
-			#-----------------------------------
-			threasoldValues = []
-			for tCode in trbcCodeList:
-				metMatch = TESTING_MET_db[TESTING_MET_db['TRBC Activity'] == tCode]
-				if metMatch.empty:
-					threasoldValues.append('')
-				else:
-					threasoldValues.append(metMatch.iloc[0]['Used for testing'])
-
-			#print('Threshold values: %s' % threasoldValues)
-			thresholdTest = []
-			for i in range(len(repValues)):
-				if pd.isnull(repValues[i]):
-					thresholdTest.append('Data not available')
-				elif not repValues[i]:
-					thresholdTest.append('')
-				elif repValues[i] > threasoldValues[i]:
-					thresholdTest.append('Not in Scope')
-				else:
-					thresholdTest.append('Pass - Aligned')
+		repValues = []
+		for almn in alignedMetricName:
+			if almn in esgData.columns:
+				repValues.append(esgData[almn][0])
+			else:
+				repValues.append('')
 
-			#print('Threshold test: %s' % thresholdTest)
-			txkSeg.at[idx, 'Threshold Test'] = ', '.join(str(e) for e in thresholdTest)
-			# Step 12: Count the TRBC which have passed/failed/require more testing on the threshold
-			#print('Count of codes passed/failed etc: %s' % {i:thresholdTest.count(i) for i in thresholdTest})
+		#print('Reported values: %s' % repValues)
+
+		# Step 9: Does it pass threashold test (threshold values collected in Step 7)
+		#-----------------------------------
+		#print('Threshold values: %s' % threasoldValues)
+		thresholdTest = []
+		for i in range(len(repValues)):
+			thresholdTest.append(thresholdResult(repValues[i], threasoldValues[i]))
+
+		#print('Threshold test: %s' % thresholdTest)
+		# Step 12: Count the TRBC which have passed/failed/require more testing on the threshold
+		#print('Count of codes passed/failed etc: %s' % {i:thresholdTest.count(i) for i in thresholdTest})
+		for i in range(len(trbcCodeList)):
+			codeRows.append((idx, trbcCodeList[i], matchAgainstTaxo[i], alignedMetricName[i], repValues[i], thresholdTest[i], hasMetric[i]))
 
 
 		# Step 10: What is the weight of each code per segment
@@ -304,55 +895,1013 @@ def getTaxoForRic(ric, buisData, esgData):
 		'Total': sumSeries['Aligned'] + sumSeries['Additional Testing Required'] + sumSeries['Not in Scope'] + sumSeries['Others']
 	}
 
-	return aggD, txkSeg
+	return aggD, SegmentTable(txkSeg, pd.DataFrame(codeRows, columns=SEGMENT_CODE_COLUMNS))
 
 
 
 
 #==============================================
-def generateReport(rFileName, orgDF, sectorDF, dnshDF):
+# process taxonomy data one RIC at a time, results go to a ResultCollector
+def scoreRics(ricList, taxonMaster, esgMaster, results, taxonRows=None, esgRows=None, db=None, ricTimes=None):
 #==============================================
-	sectorDF = sectorDF.astype(object)
-	sectorDF.fillna('', inplace=True)
-	orgDF.fillna('', inplace=True)
-	dnshDF = dnshDF.astype(object)
-	dnshTemp = pd.DataFrame(dnshDF)
-	dnshDF.fillna('', inplace=True)
-	dnshTemp.fillna(0, inplace=True)
+	# row positions of each instrument, instead of filtering the frames for every RIC
+	if taxonRows is None:
+		taxonRows = taxonMaster.groupby('Instrument', sort=False).indices
+	if esgRows is None:
+		esgRows = esgMaster.groupby('Instrument', sort=False).indices
 
-	# define the spreadsheet styles
-	header = NamedStyle(name="header")
-	header.font = Font(bold=True)
-	header.border = Border(bottom=Side(border_style="thin"))
-	header.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+	for instr in ricList:
+		start = time.perf_counter()
+		# get sub frame for this instrument
+		subDF = taxonMaster.iloc[taxonRows.get(instr, [])].reset_index(drop=True)
+		esgData = esgMaster.iloc[esgRows.get(instr, [])].reset_index(drop=True)
+		report, msubDF = getTaxoForRic(instr, subDF, esgData, db)
+		# collect the data, frames are concatenated once all the instruments are done
+		results.add(report, msubDF)
+		if ricTimes is not None:
+			ricTimes.append(time.perf_counter() - start)
 
 
-	def addDataFrame(theSht, sourceDF):
-		curRow = theSht._current_row
-		for row in dataframe_to_rows(sourceDF, index=False, header=True):
-			theSht.append(row)
-		header_row = theSht[curRow + 1]
-		for cell in header_row:
-			cell.style = header
 
+#==============================================
+# worker process: score one shard of the portfolio with the data in WORKER_DATA
+def scoreShard(shard):
+#==============================================
+	return scoreShardData(shard, *WORKER_DATA)
 
-	def columnFormats(sheet, fDict):
-		for ckey, cformat in fDict.items():
-			col = sheet[ckey]
-			for cell in col:
-				cell.number_format = cformat
 
 
-	def columnWidths(sheet, sDict):
-		for ckey, cWidth in sDict.items():
-			sheet.column_dimensions[ckey].width = cWidth
+#==============================================
+# worker process of a pool kept between portfolios: score a shard sent with its rows, WORKER_DATA is the database
+def scoreShardRows(task):
+#==============================================
+	shard, taxonMaster, esgMaster, engine = task
+	return scoreShardData(shard, taxonMaster, esgMaster, None, None, engine, WORKER_DATA)
 
 
-	workbook = Workbook()
-	# First sheet with summary data
-	ws1 = workbook.active
-	ws1.title = 'Organization Summary'
-	# Append summary data to first sheet
+
+#==============================================
+def scoreShardData(shard, taxonMaster, esgMaster, taxonRows, esgRows, engine, db):
+#==============================================
+	if engine == 'batch':
+		orgDF, sectorDF = scorePortfolio(shard, taxonMaster[taxonMaster['Instrument'].isin(shard)], esgMaster[esgMaster['Instrument'].isin(shard)], db)
+		return orgDF.to_dict('records'), sectorDF, []
+
+	results = ResultCollector()
+	ricTimes = []
+	scoreRics(shard, taxonMaster, esgMaster, results, taxonRows, esgRows, db, ricTimes)
+	return results.records, results.segments(), ricTimes
+
+
+
+#==============================================
+# worker process initializer when the data cannot be inherited by fork
+def initWorker(workerData):
+#==============================================
+	global WORKER_DATA
+	WORKER_DATA = workerData
+
+
+
+#==============================================
+# process pool whose workers see WORKER_DATA
+def workerPool(workers):
+#==============================================
+	methods = multiprocessing.get_all_start_methods()
+	if 'fork' in methods and threading.active_count() == 1:
+		# the workers share the data with this process
+		return multiprocessing.get_context('fork').Pool(workers)
+	# forking while other threads run (service handlers, pipeline stages) could copy the locks they hold, e.g. of the SQLite cache
+	# the data is then sent once to each worker, not with every task
+	if 'forkserver' in methods:
+		context = multiprocessing.get_context('forkserver')
+		# imported once by the fork server instead of by every worker
+		context.set_forkserver_preload(['numpy', 'pandas', 'openpyxl'])
+	else:
+		context = multiprocessing.get_context('spawn')
+	return context.Pool(workers, initializer=initWorker, initargs=(WORKER_DATA,))
+
+
+
+#==============================================
+# process taxonomy data on several processes, results are collected in portfolio order
+def scoreInParallel(ricList, taxonMaster, esgMaster, results, workers, engine='ric', db=None, ricTimes=None, pool=None):
+#==============================================
+	# pool is an optional workerPool whose WORKER_DATA is the database, kept between portfolios (see TaxonomyCalculator.openPool)
+	global WORKER_DATA
+	if db is None:
+		db = DATABASE
+	# a few shards per worker to even out the load, each shard is a contiguous slice of the portfolio
+	# a call of the batch engine has a fixed cost (~0.1s), it gets one shard per worker
+	shardSize = max(1, -(-len(ricList) // (workers if engine == 'batch' else workers * 4)))
+	shards = [ricList[i:i + shardSize] for i in range(0, len(ricList), shardSize)]
+
+	if pool is not None:
+		# the workers already run, each shard is sent with its rows
+		tasks = [(shard, taxonMaster[taxonMaster['Instrument'].isin(shard)], esgMaster[esgMaster['Instrument'].isin(shard)], engine) for shard in shards]
+		collectShards(pool.imap(scoreShardRows, tasks), results, ricTimes)
+		return
+
+	# one portfolio at a time in WORKER_DATA when several are scored from threads (service mode)
+	with WORKER_LOCK:
+		WORKER_DATA = (taxonMaster, esgMaster, taxonMaster.groupby('Instrument', sort=False).indices, esgMaster.groupby('Instrument', sort=False).indices, engine, db)
+		try:
+			with workerPool(workers) as pool:
+				collectShards(pool.imap(scoreShard, shards), results, ricTimes)
+		finally:
+			WORKER_DATA = None
+
+
+
+#==============================================
+# results of the shards, in portfolio order
+def collectShards(shardResults, results, ricTimes=None):
+#==============================================
+	for reports, segDF, shardTimes in shardResults:
+		results.extend(reports, segDF)
+		if ricTimes is not None:
+			ricTimes.extend(shardTimes)
+
+
+
+#==============================================
+# Threshold test outcome for a single TRBC code (Step 9)
+def thresholdResult(repValue, threshold):
+#==============================================
+	if pd.isnull(repValue):
+		return 'Data not available'
+	elif not repValue:
+		return ''
+	elif repValue > threshold:
+		return 'Not in Scope'
+	else:
+		return 'Pass - Aligned'
+
+
+
+#==============================================
+# turn a lookup index into a frame which can be merged on its key column
+def indexFrame(index, keyName, valueNames):
+#==============================================
+	frame = pd.DataFrame(list(index.values()), columns=valueNames, dtype=object)
+	frame.insert(0, keyName, pd.Series(list(index.keys()), dtype=object))
+	return frame
+
+
+
+#==============================================
+# (start, end) positions of each run of the same instrument in a column
+def instrumentBounds(instruments):
+#==============================================
+	values = instruments.to_numpy()
+	if len(values) == 0:
+		return []
+	change = np.flatnonzero(values[1:] != values[:-1]) + 1
+	return list(zip(np.r_[0, change], np.r_[change, len(values)]))
+
+
+
+#==============================================
+# process taxonomy data for the whole portfolio at once
+def scorePortfolio(ricList, taxonMaster, esgMaster, db=None):
+#==============================================
+	if db is None:
+		db = DATABASE
+	revCol = 'Business Total Revenues (Calculated)'
+
+	# portfolio order, a RIC listed twice is scored once and repeated in the output
+	order = pd.DataFrame({'Instrument': ricList})
+	order['_pos'] = range(len(order))
+	rics = order.drop_duplicates('Instrument')['Instrument']
+
+	esgData = esgMaster.drop_duplicates('Instrument').set_index('Instrument')
+	esgData = esgData.reindex(rics)
+	buisData = pd.DataFrame(taxonMaster[taxonMaster['Instrument'].isin(rics)])
+	buisData['_row'] = buisData.groupby('Instrument', sort=False).cumcount()
+	# keep the rows of each instrument together, in portfolio order
+	ricRank = pd.Series(range(len(rics)), index=rics.values)
+	buisData = buisData.iloc[buisData['Instrument'].map(ricRank).argsort(kind='stable')]
+
+	# Step 3: Calculate the segment revenue share, RICs without usable revenues are processed as empty
+	#-----------------------------------
+	firstRev = buisData[buisData['_row'] == 0].set_index('Instrument')[revCol]
+	hasData = firstRev.index[firstRev.notnull()]
+	segMask = ~buisData['Segment Code'].str.match(SEGMENT_EXCLUDE, na=True)
+	txkSeg = pd.DataFrame(buisData[segMask & buisData['Instrument'].isin(hasData)])
+	# summed one by one like sum() in the per RIC path, a missing segment revenue makes the total NaN
+	bounds = instrumentBounds(txkSeg['Instrument'])
+	starts = [start for start, end in bounds]
+	revenues = txkSeg[revCol].to_numpy(dtype=float)
+	revTotal = pd.Series([sum(revenues[start:end].tolist()) for start, end in bounds], index=txkSeg['Instrument'].to_numpy()[starts], dtype=float)
+	scored = revTotal.index[~(revTotal < 10)]
+	txkSeg = txkSeg[txkSeg['Instrument'].isin(scored)]
+
+	delisted = txkSeg['Instrument'].str.contains('^', regex=False)
+	txkSeg.insert(1, 'Name', txkSeg['Instrument'].map(esgData['Company Common Name']))
+	txkSeg.insert(2, 'Delisted', delisted.map({True: 'Delisted', False: ''}))
+	txkSeg['Segment Revenue Ratio'] = txkSeg[revCol] / txkSeg['Instrument'].map(revTotal)
+	txkSeg['_seg'] = range(len(txkSeg))
+
+	# Step 5: Convert NAICS code to TRBC codes, one row per segment code
+	#-----------------------------------
+	segCodeList = txkSeg['Segment Code'].str.split(',')
+	codes = pd.DataFrame({'_seg': txkSeg['_seg'].values, 'Instrument': txkSeg['Instrument'].values, 'NAICS': segCodeList.values}).explode('NAICS')
+	codes = codes[codes['NAICS'].str.isnumeric().fillna(False).astype(bool)]
+	codes['NAICS'] = pd.Series([naicsKey(c) for c in codes['NAICS']], index=codes.index, dtype=object)
+	codes = codes.merge(indexFrame(db.naicsTrbcIdx, 'NAICS', ['TRBC Code']), on='NAICS', how='left', indicator='_trbc')
+	codes['TRBC Code'] = codes['TRBC Code'].where(codes['_trbc'] == 'both', 0)
+
+	# Step 6: match against EU taxonomy
+	#-----------------------------------
+	codes = codes.merge(indexFrame(db.taxonIdx, 'TRBC Code', ['Match']), on='TRBC Code', how='left', indicator='_taxo')
+	codes['Match'] = codes['Match'].where(codes['_taxo'] == 'both', 'na')
+
+	# Step 7: Is TRBC Code aligned to assesement metric
+	#-----------------------------------
+	codes = codes.merge(indexFrame(db.metricIdx, 'TRBC Code', ['Measure', 'Field', 'Threshold']), on='TRBC Code', how='left', indicator='_metric')
+	codes['Metric'] = codes['_metric'] == 'both'
+	codes['Measure'] = codes['Measure'].where(codes['Metric'], '')
+	codes['Threshold'] = codes['Threshold'].where(codes['Metric'], '')
+
+	# Step 8: What is company reported value for aligned metric
+	#-----------------------------------
+	measures = [m for m in dict.fromkeys(codes['Measure']) if m in esgData.columns]
+	repValues = esgData[measures].reset_index().melt(id_vars='Instrument', var_name='Measure', value_name='Reported')
+	codes = codes.merge(repValues.astype(object), on=['Instrument', 'Measure'], how='left', indicator='_rep')
+	codes['Reported'] = codes['Reported'].where(codes['_rep'] == 'both', '')
+
+	# Step 9: Does it pass threashold test
+	#-----------------------------------
+	codes['Outcome'] = [thresholdResult(v, t) for v, t in zip(codes['Reported'], codes['Threshold'])]
+	codes['No'] = codes['Match'] == 'No'
+	codes['Yes'] = codes['Match'] == 'Yes'
+	codes['na'] = codes['Match'] == 'na'
+	codes['Pass'] = codes['Outcome'] == 'Pass - Aligned'
+	codes['NoData'] = codes['Outcome'] == 'Data not available'
+	codes['NotInScope'] = codes['Outcome'] == 'Not in Scope'
+
+	codes = codes.sort_values('_seg', kind='stable')
+	perSeg = codes.groupby('_seg').agg(**{
+		'nCodes': ('Match', 'size'),
+		'Metric': ('Metric', 'any'),
+		'No': ('No', 'sum'),
+		'Yes': ('Yes', 'sum'),
+		'na': ('na', 'sum'),
+		'Pass': ('Pass', 'sum'),
+		'NoData': ('NoData', 'sum'),
+		'NotInScope': ('NotInScope', 'sum')
+	}).reindex(txkSeg['_seg'])
+	perSeg.index = txkSeg.index
+	hasMetric = perSeg['Metric'].fillna(False).astype(bool)
+
+	# Step 10: What is the weight of each code per segment
+	#-----------------------------------
+	txkSeg['Segment Weight'] = 1 / segCodeList.str.len()
+
+	# Step 13: Convert taxo result into %
+	#-----------------------------------
+	segRev = txkSeg['Segment Revenue Ratio'] * txkSeg['Segment Weight']
+	counts = perSeg[['No', 'Yes', 'na', 'Pass', 'NoData', 'NotInScope']].fillna(0)
+	txkSeg['Aligned'] = segRev * counts['No']
+	txkSeg['Additional Testing Required'] = segRev * counts['Yes']
+	txkSeg['Not in Scope'] = segRev * counts['na']
+	txkSeg['Others'] = segRev.where(perSeg['nCodes'].isnull(), 0.)
+	txkSeg['Aligned- Pass'] = (segRev * counts['Pass']).where(hasMetric, 0.)
+	txkSeg['Aligned- No Data'] = (segRev * counts['NoData']).where(hasMetric, 0.)
+	txkSeg['Aligned- Not in Scope'] = (segRev * counts['NotInScope']).where(hasMetric, 0.)
+
+	# Step 14: Aggregate the business segments into parent company
+	#-----------------------------------
+	# the per RIC path uses DataFrame.sum (numpy pairwise summation), groupby sum rounds differently
+	sumCols = ['Aligned', 'Additional Testing Required', 'Not in Scope', 'Others', 'Aligned- Pass', 'Aligned- No Data', 'Aligned- Not in Scope']
+	bounds = instrumentBounds(txkSeg['Instrument'])
+	starts = [start for start, end in bounds]
+	values = txkSeg[sumCols].to_numpy(dtype=float).T
+	values = np.ascontiguousarray(np.where(np.isnan(values), 0., values))
+	sumDF = pd.DataFrame([values[:, start:end].sum(axis=1) for start, end in bounds], columns=sumCols, index=txkSeg['Instrument'].to_numpy()[starts], dtype=float)
+	aggDF = pd.DataFrame({
+		'Aligned by Industry': sumDF['Aligned'],
+		'Additional Testing Required': sumDF['Additional Testing Required'],
+		'Eligible': sumDF['Aligned'] + sumDF['Additional Testing Required'],
+		'Not In Scope': sumDF['Not in Scope'],
+		'Others': sumDF['Others'],
+		'Aligned- Pass': sumDF['Aligned- Pass'],
+		'Aligned- No Data': sumDF['Aligned- No Data'],
+		'Aligned- Not in Scope': sumDF['Aligned- Not in Scope'],
+		'Additional testing needed': sumDF['Additional Testing Required'] - sumDF['Aligned- Pass'] + sumDF['Aligned- Not in Scope'],
+		'Total': sumDF['Aligned'] + sumDF['Additional Testing Required'] + sumDF['Not in Scope'] + sumDF['Others']
+	})
+
+	# Step 15: Is parent company eligible (RICs with no usable segment data)
+	#-----------------------------------
+	emptyRics = rics[~rics.isin(scored)]
+	parentTRBCode = esgData['TRBC Activity Code'].reindex(emptyRics)
+	parentTRBCode = parentTRBCode[parentTRBCode.notnull()]
+	inTaxo = parentTRBCode.map(lambda c: c in db.taxonIdx).astype(bool)
+	emptyDF = pd.DataFrame(index=pd.Index(emptyRics, name='Instrument'), columns=['Parent Eligible', 'Parent Eligible ratio', 'Parent Not In Scope ratio'], dtype=object)
+	emptyDF.loc[inTaxo.index[inTaxo], 'Parent Eligible'] = [db.taxonIdx[c] for c in parentTRBCode[inTaxo]]
+	emptyDF.loc[inTaxo.index[inTaxo], 'Parent Eligible ratio'] = 1
+	emptyDF.loc[inTaxo.index[~inTaxo], 'Parent Eligible'] = 'Not in scope'
+	emptyDF.loc[inTaxo.index[~inTaxo], 'Parent Not In Scope ratio'] = 1
+
+	orgDF = pd.concat([aggDF, emptyDF])
+	orgDF.index.name = 'Instrument'
+	orgDF = orgDF.reset_index()
+	orgDF.insert(1, 'Name', orgDF['Instrument'].map(esgData['Company Common Name']))
+	orgDF.insert(2, 'Delisted', orgDF['Instrument'].str.contains('^', regex=False).map({True: 'Yes', False: ''}))
+	orgDF.insert(3, 'ESG Score', orgDF['Instrument'].map(esgData['ESG Score']))
+	orgDF.insert(4, 'Economic Sector', orgDF['Instrument'].map(esgData['TRBC Economic Sector Name']))
+	orgDF.insert(5, 'TRBC Activity', orgDF['Instrument'].map(esgData['TRBC Activity Name']))
+	orgDF = order.merge(orgDF, on='Instrument').sort_values('_pos', kind='stable')
+	orgDF = orgDF.reindex(columns=ORG_COLUMNS).reset_index(drop=True)
+
+	# segments of the empty RICs are reported as received, flagged with No Data
+	emptySeg = pd.DataFrame(buisData[buisData['Instrument'].isin(emptyRics)])
+	emptySeg['Name'] = emptySeg['Instrument'].map(esgData['Company Common Name'])
+	emptySeg['Delisted'] = emptySeg['Instrument'].str.contains('^', regex=False).map({True: 'Delisted, No Data', False: 'No Data'})
+
+	# column order follows the first instrument, as if the frames were appended one by one
+	if len(order) > 0 and order['Instrument'].iloc[0] not in scored:
+		sectorDF = pd.concat([emptySeg, txkSeg])
+	else:
+		sectorDF = pd.concat([txkSeg, emptySeg])
+	sectorDF = order.merge(sectorDF, on='Instrument').sort_values(['_pos', '_row'], kind='stable')
+	sectorDF = sectorDF.drop(columns=['_pos', '_row']).reset_index(drop=True)
+
+	# the codes follow their segment rows, repeated with them for a RIC listed twice
+	segPos = pd.DataFrame({'_seg': sectorDF['_seg'], '_pos': range(len(sectorDF))}).dropna().astype('int64')
+	codes = codes.merge(segPos, on='_seg').sort_values('_pos', kind='stable')
+	codes['_seg'] = codes['_pos']
+	return orgDF, SegmentTable(sectorDF.drop(columns='_seg'), codes.reset_index(drop=True))
+
+
+
+#==============================================
+# DNSH data as typed columns (Int16 counts, bool flags) with the environment red flag and the social controversies total
+def scoreDnsh(dnshDF):
+#==============================================
+	scores = pd.DataFrame({'Instrument': dnshDF['Instrument']}, index=dnshDF.index)
+	for column in dnshDF.columns.drop('Instrument'):
+		if column in DNSH_FLAGS:
+			scores[column] = dnshDF[column].isin([True, 'True'])
+		else:
+			scores[column] = pd.to_numeric(dnshDF[column], errors='coerce').astype('Int16')
+	count = lambda name: scores[name].fillna(0) if name in scores.columns else 0
+	flag = lambda name: scores[name] if name in scores.columns else False
+
+	counts = [c for c in scores.columns if c != 'Instrument' and c not in DNSH_FLAGS]
+	envCount = count('Environmental Controversies Count') + count('Recent Environmental Controversies')
+	promotes = flag('Environmental Products') | flag('Land Environmental Impact Reduction') | flag('Eco-Design Products')
+	scores['Environment Controversies'] = pd.Series(envCount, index=scores.index).astype('Int16')
+	scores['Promotes Environmental Products'] = pd.Series(promotes, index=scores.index).astype(bool)
+	scores['Environment Red Flag'] = scores['Promotes Environmental Products'] & (scores['Environment Controversies'] > 0)
+	scores['Social Controversies'] = scores[counts].fillna(0).sum(axis=1).astype('Int32')
+	return scores
+
+
+
+#==============================================
+# a loaded database and a data source, scores any number of portfolios
+class TaxonomyCalculator:
+#==============================================
+	def __init__(self, db='database.xlsx', fetcher=None, engine='batch', workers=1, spillRows=0, useSnapshot=True, state=None, metrics=None):
+		# db is a TaxonomyDatabase or the excel spreadsheet to open, fetcher a DataFetcher (default: eikon, no cache)
+		# state is a ScoreStore, instruments whose data and database entries did not change since the last run are not scored again
+		if not isinstance(db, TaxonomyDatabase):
+			db = openDatabase(db, useSnapshot)
+		self.db = db
+		self.fetcher = fetcher if fetcher is not None else DataFetcher()
+		self.engine = engine
+		self.workers = workers
+		self.spillRows = spillRows
+		self.state = state
+		self.reused = 0
+		# process pool kept between portfolios (see openPool), otherwise each portfolio starts its own
+		self.pool = None
+		# stage times of every run, the fetcher reports its requests to the same metrics
+		self.metrics = metrics if metrics is not None else RunMetrics()
+		if self.fetcher.metrics is None:
+			self.fetcher.metrics = self.metrics
+
+
+	def fetch(self, ricList):
+		# data of the portfolio, in offline mode only the instruments found in the cache are kept
+		with self.metrics.stage('getData'):
+			taxonMaster, esgMaster, dnshMaster = getData(ricList, self.fetcher, self.db)
+		if self.fetcher.offline:
+			available = set(taxonMaster['Instrument']) & set(esgMaster['Instrument'])
+			missing = [ric for ric in ricList if ric not in available]
+			if missing:
+				print('Offline mode: no cached data for [%s] instruments: %s ...' % (len(missing), missing[0:4]))
+				ricList = [ric for ric in ricList if ric in available]
+				dnshMaster = dnshMaster[dnshMaster['Instrument'].isin(available)].reset_index(drop=True)
+		return ricList, taxonMaster, esgMaster, dnshMaster
+
+
+	def run(self, ricList):
+		# the segments may be a generator of frames, the ResultCollector returned with them is closed once they are consumed
+		return self.scoreData(*self.fetch(ricList))
+
+
+	def scoreData(self, ricList, taxonMaster, esgMaster, dnshMaster):
+		# score the data returned by fetch()
+		with self.metrics.stage('scoreDnsh'):
+			dnshScores = scoreDnsh(dnshMaster)
+		with self.metrics.stage('scoring'):
+			self.metrics.addInstruments(len(ricList))
+			return self.scoreFrames(ricList, taxonMaster, esgMaster, dnshScores)
+
+
+	def scoreFrames(self, ricList, taxonMaster, esgMaster, dnshMaster):
+		if self.state is not None:
+			return self.runIncremental(ricList, taxonMaster, esgMaster, dnshMaster)
+		return self.scoreAll(ricList, taxonMaster, esgMaster, dnshMaster)
+
+
+	def scoreAll(self, ricList, taxonMaster, esgMaster, dnshMaster):
+		# score every instrument with the engine and workers of the calculator
+		if not ricList:
+			# nothing to score (e.g. offline without cached data), the frames may not have the eikon columns
+			return pd.DataFrame(columns=ORG_COLUMNS), SegmentTable(), dnshMaster, None
+		if self.engine == 'batch' and self.workers <= 1:
+			# process taxo data for the whole portfolio at once
+			orgDF, sectorDF = scorePortfolio(ricList, taxonMaster, esgMaster, self.db)
+			return orgDF, sectorDF, dnshMaster, None
+
+		results = ResultCollector(self.spillRows)
+		ricTimes = []
+		if self.workers > 1:
+			# shards of the portfolio on several processes
+			scoreInParallel(ricList, taxonMaster, esgMaster, results, self.workers, self.engine, self.db, ricTimes, self.pool)
+		else:
+			# process taxo data for each instrument in the list
+			scoreRics(ricList, taxonMaster, esgMaster, results, db=self.db, ricTimes=ricTimes)
+		self.metrics.addRics(ricTimes)
+		return results.organizations(), results.segmentChunks(), dnshMaster, results
+
+
+	def runIncremental(self, ricList, taxonMaster, esgMaster, dnshMaster):
+		# reuse the stored results of the instruments whose fingerprint did not change, score the others
+		if not ricList:
+			return self.scoreAll(ricList, taxonMaster, esgMaster, dnshMaster)
+		fingerprints = portfolioFingerprints(ricList, taxonMaster, esgMaster, self.db)
+		storedOrg, storedSeg = self.state.get(fingerprints)
+		self.reused = len(storedOrg)
+		self.metrics.addInstruments(0, self.reused)
+
+		orgParts, segParts = [storedOrg], [storedSeg]
+		reused = set(storedOrg['Instrument'])
+		changed = [ric for ric in fingerprints if ric not in reused]
+		if changed:
+			taxonChanged = taxonMaster[taxonMaster['Instrument'].isin(changed)]
+			esgChanged = esgMaster[esgMaster['Instrument'].isin(changed)]
+			if self.workers > 1:
+				results = ResultCollector()
+				scoreInParallel(changed, taxonChanged, esgChanged, results, self.workers, 'batch', self.db)
+				orgDF, sectorDF = results.organizations(), results.segments()
+			else:
+				orgDF, sectorDF = scorePortfolio(changed, taxonChanged, esgChanged, self.db)
+			self.state.put({ric: fingerprints[ric] for ric in changed}, orgDF, sectorDF)
+			orgParts.append(orgDF)
+			segParts.append(sectorDF)
+		print('Incremental scoring: [%s] instruments reused, [%s] scored' % (self.reused, len(changed)))
+
+		# the stored and scored rows in portfolio order, with the columns the scoring of the whole portfolio gives
+		orgDF = pd.concat([part for part in orgParts if len(part)], ignore_index=True)
+		orgDF = orgDF.iloc[pd.Index(orgDF['Instrument']).get_indexer(ricList)].reset_index(drop=True)
+		sectorDF = SegmentTable.concat([part for part in segParts if len(part)]).takeInstruments(ricList)
+		return orgDF, sectorDF.orderColumns(ricList[0], pd.isnull(orgDF['Total'].iloc[0])), dnshMaster, None
+
+
+	def runPeriods(self, ricList, periods):
+		# organization ratios of the portfolio for each period, one row per instrument and period
+		# the segment and ESG data of all the periods is fetched at once, the database is shared
+		with self.metrics.stage('getData'):
+			frames = self.fetcher.getPeriodFields(ricList, {'Segment': SEGMENT_FIELDS, 'ESG': self.db.esgFields}, periods)
+
+		series = []
+		with self.metrics.stage('scoring'):
+			for period in periods:
+				periodFrames = frames.pop(period)
+				taxonMaster, esgMaster = periodFrames['Segment'], periodFrames['ESG']
+				rics = ricList
+				if self.fetcher.offline:
+					available = set(taxonMaster['Instrument']) & set(esgMaster['Instrument'])
+					rics = [ric for ric in ricList if ric in available]
+				self.metrics.addInstruments(len(rics))
+				orgDF, sectorDF, dnshDF, results = self.scoreAll(rics, taxonMaster, esgMaster, None)
+				if results is not None:
+					results.close()
+				orgDF.insert(1, 'Period', period)
+				series.append(orgDF[['Instrument', 'Period'] + TIME_SERIES_COLUMNS])
+
+		# the periods of an instrument together, in portfolio order
+		seriesDF = pd.concat(series, ignore_index=True)
+		position = pd.Series(range(len(ricList)), index=ricList)
+		position = position[~position.index.duplicated()]
+		seriesDF = seriesDF.iloc[seriesDF['Instrument'].map(position).argsort(kind='stable')]
+		return seriesDF.astype({c: float for c in TIME_SERIES_COLUMNS}).reset_index(drop=True)
+
+
+	def score(self, rics):
+		# organization frame, SegmentTable and DNSH frame of a portfolio
+		orgDF, sectorDF, dnshDF, results = self.run(rics)
+		if results is not None:
+			sectorDF = results.segments()
+			results.close()
+		return orgDF, sectorDF, dnshDF
+
+
+	def openPool(self):
+		# one process pool for the portfolios scored next (e.g. the batches of a pipeline), the database is sent once to each worker
+		# opened before other threads start, the workers can then be forked
+		global WORKER_DATA
+		if self.workers <= 1 or self.pool is not None:
+			return
+		with WORKER_LOCK:
+			WORKER_DATA = self.db
+			try:
+				self.pool = workerPool(self.workers)
+			finally:
+				WORKER_DATA = None
+
+
+	def closePool(self):
+		if self.pool is not None:
+			self.pool.close()
+			self.pool.join()
+			self.pool = None
+
+
+	def close(self):
+		self.closePool()
+		if self.fetcher.cache is not None:
+			self.fetcher.cache.close()
+		if self.state is not None:
+			self.state.close()
+
+
+
+#==============================================
+# HTTP/JSON front end of a TaxonomyCalculator: POST /score {"rics": [...]}, GET /health, GET /metrics
+class TaxonomyRequestHandler(BaseHTTPRequestHandler):
+#==============================================
+	calculator = None
+
+	def do_GET(self):
+		if self.path == '/health':
+			self.sendJson(200, {'status': 'ok'})
+		elif self.path == '/metrics':
+			self.sendJson(200, self.calculator.metrics.summary())
+		else:
+			self.sendJson(404, {'error': 'Unknown path %s' % self.path})
+
+
+	def do_POST(self):
+		if self.path != '/score':
+			self.sendJson(404, {'error': 'Unknown path %s' % self.path})
+			return
+		try:
+			request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+			rics = request['rics']
+			if not isinstance(rics, list) or not rics or not all(isinstance(ric, str) and ric for ric in rics):
+				raise ValueError('rics must be a non empty list of RICs')
+		except (ValueError, KeyError, TypeError) as e:
+			self.sendJson(400, {'error': 'Invalid request: %s' % e})
+			return
+
+		try:
+			orgDF, sectorDF, dnshDF = self.calculator.score(rics)
+		except Exception as e:
+			self.sendJson(500, {'error': str(e)})
+			return
+		# to_json writes NaN as null and handles the numpy types
+		body = '{"organizations": %s, "segments": %s, "dnsh": %s}' % (orgDF.to_json(orient='records'), sectorDF.render().to_json(orient='records'), dnshDF.to_json(orient='records'))
+		self.sendJson(200, body)
+
+
+	def sendJson(self, status, body):
+		data = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+
+
+#==============================================
+# keep the calculator warm and answer scoring requests until interrupted
+def serve(calculator, port, host='127.0.0.1'):
+#==============================================
+	handler = type('Handler', (TaxonomyRequestHandler,), {'calculator': calculator})
+	server = ThreadingHTTPServer((host, port), handler)
+	print('Serving taxonomy requests on http://%s:%i/score' % (host, port))
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+
+
+#==============================================
+# segment results: the segment rows with their ratios, and the TRBC codes of the segments as a long table
+class SegmentTable:
+#==============================================
+	def __init__(self, segments=None, codes=None):
+		# codes has the SEGMENT_CODE_COLUMNS, eligibility and threshold outcomes are kept as categories
+		self.segments = pd.DataFrame() if segments is None else segments
+		if codes is None:
+			codes = pd.DataFrame(columns=SEGMENT_CODE_COLUMNS)
+		self.codes = codes.reindex(columns=SEGMENT_CODE_COLUMNS).astype(SEGMENT_CODE_DTYPES)
+
+
+	def __len__(self):
+		return len(self.segments)
+
+
+	@staticmethod
+	def concat(tables):
+		tables = list(tables)
+		if not tables:
+			return SegmentTable()
+		segments = pd.concat([table.segments for table in tables], ignore_index=True)
+		codes = pd.concat([table.codes for table in tables], ignore_index=True)
+		# segment positions move by the rows of the tables before
+		offsets = np.cumsum([0] + [len(table.segments) for table in tables[:-1]])
+		codes['_seg'] += np.repeat(offsets, [len(table.codes) for table in tables])
+		return SegmentTable(segments, codes)
+
+
+	def take(self, positions, codeRows=None):
+		# table of the segment rows at the given positions (each one once, in the order given), codeRows are the rows of their codes when known
+		positions = np.asarray(positions, dtype=np.int64)
+		if codeRows is None:
+			codeRows = np.flatnonzero(self.codes['_seg'].isin(positions))
+		codes = self.codes.iloc[np.asarray(codeRows, dtype=np.int64)].reset_index(drop=True)
+		codes['_seg'] = pd.Series(np.arange(len(positions)), index=positions).reindex(codes['_seg']).to_numpy()
+		codes = codes.sort_values('_seg', kind='stable').reset_index(drop=True)
+		return SegmentTable(self.segments.iloc[positions].reset_index(drop=True), codes)
+
+
+	def takeInstruments(self, rics):
+		# table of the rows of the given instruments in that order, an instrument listed twice is repeated
+		if len(self.segments) == 0:
+			return self
+		segRows, codeRows = self.rowsByInstrument()
+		empty = np.empty(0, dtype=np.int64)
+		segParts = [segRows.get(ric, empty) for ric in rics]
+		codeParts = [codeRows.get(ric, empty) for ric in rics]
+		positions = np.concatenate([empty] + segParts)
+		codePositions = np.concatenate([empty] + codeParts)
+		# a code moves to the first new row of its instrument plus the number of its segment within the instrument
+		segNumber = self.segments.groupby('Instrument', sort=False).cumcount().to_numpy()
+		firstRows = np.cumsum([0] + [len(part) for part in segParts[:-1]])
+		codes = self.codes.iloc[codePositions].reset_index(drop=True)
+		codes['_seg'] = np.repeat(firstRows, [len(part) for part in codeParts]) + segNumber[codes['_seg'].to_numpy()]
+		codes = codes.sort_values('_seg', kind='stable').reset_index(drop=True)
+		return SegmentTable(self.segments.iloc[positions].reset_index(drop=True), codes)
+
+
+	def rowsByInstrument(self):
+		# {ric: segment row positions} and {ric: code row positions}, to take() the rows of some instruments
+		if len(self.segments) == 0:
+			return {}, {}
+		segRows = self.segments.groupby('Instrument', sort=False).indices
+		codeRics = self.segments['Instrument'].to_numpy()[self.codes['_seg'].to_numpy()]
+		codeRows = self.codes.groupby(codeRics, sort=False).indices if len(self.codes) else {}
+		return segRows, codeRows
+
+
+	def orderColumns(self, firstRic, noData=False):
+		# table with the columns in the order the per RIC engine gives them when firstRic comes first: name and status after
+		# the instrument when it is scored (getTaxoForRic), after the fields received when it has no data (processEmpty)
+		# noData is used when firstRic has no segment rows
+		segments = self.segments
+		if len(segments.columns) == 0:
+			return self
+		status = segments['Delisted'].astype(str).str.endswith('No Data')
+		firstStatus = status[(segments['Instrument'] == firstRic).to_numpy()]
+		if len(firstStatus):
+			noData = bool(firstStatus.iloc[0])
+		baseColumns = [c for c in segments.columns if c not in SEGMENT_RESULT_COLUMNS and c not in ['Name', 'Delisted']]
+		# the ratio columns come with the first scored instrument
+		scored = not status.all() if len(segments) else not noData
+		resultColumns = [c for c in SEGMENT_RESULT_COLUMNS if c not in SEGMENT_TEXT_COLUMNS] if scored else []
+		if noData:
+			columns = baseColumns + ['Name', 'Delisted'] + resultColumns
+		else:
+			columns = baseColumns[:1] + ['Name', 'Delisted'] + baseColumns[1:] + resultColumns
+		return SegmentTable(segments.reindex(columns=columns), self.codes)
+
+
+	def render(self):
+		# segment frame with the codes of each segment joined into the text columns of the report
+		sectorDF = self.segments.reset_index(drop=True)
+		if 'Segment Revenue Ratio' not in sectorDF.columns:
+			# only instruments without segment data
+			return sectorDF
+		joinStr = lambda v: ', '.join(str(e) for e in v)
+		codes = self.codes.assign(Linked=(self.codes['Measure'] != '').to_numpy(dtype=bool))
+		perSeg = codes.groupby('_seg').agg(**{
+			'TRBC Codes': ('TRBC Code', joinStr),
+			'Match with EU Taxo': ('Match', joinStr),
+			'Linked Assesment Metric': ('Measure', joinStr),
+			'Metric Reported Value': ('Reported', joinStr),
+			'Threshold Test': ('Outcome', joinStr),
+			'Linked': ('Linked', 'any'),
+			'Metric': ('Metric', 'any')
+		}).reindex(sectorDF.index)
+		linked = perSeg['Linked'].fillna(False).astype(bool)
+		hasMetric = perSeg['Metric'].fillna(False).astype(bool)
+		# without any code the columns keep the types of the codes table
+		perSeg = perSeg[SEGMENT_TEXT_COLUMNS].astype(object)
+		text = pd.DataFrame({
+			'TRBC Codes': perSeg['TRBC Codes'].fillna(''),
+			'Match with EU Taxo': perSeg['Match with EU Taxo'].fillna(''),
+			'Linked Assesment Metric': perSeg['Linked Assesment Metric'].where(linked, ''),
+			'Metric Reported Value': perSeg['Metric Reported Value'].where(hasMetric, ''),
+			'Threshold Test': perSeg['Threshold Test'].where(hasMetric, '')
+		}, dtype=object)
+		# instruments without segment data have no text, as they have no ratios
+		text = text.where(~sectorDF['Delisted'].astype(str).str.endswith('No Data'))
+
+		position = sectorDF.columns.get_loc('Segment Revenue Ratio') + 1
+		for column in reversed(SEGMENT_TEXT_COLUMNS):
+			sectorDF.insert(position, column, text[column])
+		return sectorDF
+
+
+
+
+#==============================================
+# collects the per RIC results, concatenates them once at the end
+class ResultCollector:
+#==============================================
+	def __init__(self, spillRows=0):
+		# spillRows > 0 moves the segment rows to a temporary file once that many rows are held in memory
+		self.spillRows = spillRows
+		self.records = []
+		self.segTables = []
+		self.segRows = 0
+		self.spillFile = None
+		self.spilledChunks = 0
+
+
+	def add(self, report, segTable):
+		self.extend([report], segTable)
+
+
+	def extend(self, reports, segTable):
+		# results of a block of instruments, the segments as a SegmentTable
+		self.records.extend(reports)
+		self.segTables.append(segTable)
+		self.segRows += len(segTable)
+		if self.spillRows > 0 and self.segRows >= self.spillRows:
+			self.spill()
+
+
+	def spill(self):
+		if not self.segTables:
+			return
+		if self.spillFile is None:
+			self.spillFile = tempfile.TemporaryFile(prefix='taxo_spill_')
+		pickle.dump(SegmentTable.concat(self.segTables), self.spillFile, protocol=pickle.HIGHEST_PROTOCOL)
+		self.spilledChunks += 1
+		self.segTables = []
+		self.segRows = 0
+
+
+	def organizations(self):
+		return pd.DataFrame.from_records(self.records, columns=ORG_COLUMNS)
+
+
+	def segmentChunks(self):
+		# spilled chunks first, then whatever is still in memory
+		if self.spillFile is not None:
+			self.spillFile.seek(0)
+			for i in range(self.spilledChunks):
+				yield pickle.load(self.spillFile)
+		if self.segTables:
+			yield SegmentTable.concat(self.segTables)
+
+
+	def segments(self):
+		return SegmentTable.concat(self.segmentChunks())
+
+
+	def close(self):
+		if self.spillFile is not None:
+			self.spillFile.close()
+			self.spillFile = None
+
+
+
+
+#==============================================
+# results of the previous runs with the fingerprint of the data each instrument was scored from
+class ScoreStore:
+#==============================================
+	def __init__(self, fileName, maxEntries=100000):
+		# one row per instrument (organizations), per segment (segments) and per TRBC code (codes), the maxEntries most recently used instruments are kept
+		self.maxEntries = maxEntries
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(fileName, check_same_thread=False)
+		if self.db.execute('PRAGMA user_version').fetchone()[0] != STATE_VERSION:
+			# results stored by another version are scored again
+			for (table,) in self.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+				self.db.execute('DROP TABLE "%s"' % table)
+			self.db.execute('PRAGMA user_version = %i' % STATE_VERSION)
+		# the columns have no type, the values keep the type they were stored with
+		self.db.execute('CREATE TABLE IF NOT EXISTS organizations (fingerprint, accessed, %s, PRIMARY KEY ("Instrument"))' % self.columnList(ORG_COLUMNS))
+		self.db.execute('CREATE TABLE IF NOT EXISTS codes ("Instrument", %s)' % self.columnList(SEGMENT_CODE_COLUMNS))
+		self.db.execute('CREATE INDEX IF NOT EXISTS codes_instrument ON codes ("Instrument", "_seg")')
+		self.db.execute('CREATE TEMP TABLE wanted ("Instrument" PRIMARY KEY)')
+		self.db.commit()
+		# the segment columns depend on the fields received, the table is created by put()
+		self.segColumns = [row[1] for row in self.db.execute('PRAGMA table_info(segments)')]
+
+
+	@staticmethod
+	def columnList(columns, table=None):
+		return ', '.join('%s"%s"' % (table + '.' if table else '', column) for column in columns)
+
+
+	@staticmethod
+	def sqlRows(df):
+		# rows of python values, missing values as None
+		columns = []
+		for column in df.columns:
+			values = df[column]
+			if isinstance(values.dtype, np.dtype) and values.dtype != object:
+				columns.append(values.tolist())
+			else:
+				columns.append([None if pd.isnull(v) else v.item() if isinstance(v, np.generic) else v for v in values.astype(object).tolist()])
+		return list(zip(*columns))
+
+
+	@staticmethod
+	def readFrame(rows, columns):
+		# missing values come back as None
+		df = pd.DataFrame(rows, columns=columns)
+		objects = df.columns[df.dtypes == object]
+		df[objects] = df[objects].where(df[objects].notnull(), np.nan)
+		return df
+
+
+	def get(self, fingerprints):
+		# organization frame and SegmentTable of the instruments whose stored fingerprint matches, the rows of an instrument are contiguous
+		rics = list(fingerprints)
+		found = []
+		with self.lock:
+			for i in range(0, len(rics), 500):
+				part = rics[i:i + 500]
+				query = 'SELECT "Instrument", fingerprint FROM organizations WHERE "Instrument" IN (%s)' % ','.join('?' * len(part))
+				found += [ric for ric, fingerprint in self.db.execute(query, part) if fingerprint == fingerprints[ric]]
+			if not found or not self.segColumns:
+				return pd.DataFrame(columns=ORG_COLUMNS), SegmentTable()
+
+			self.db.execute('DELETE FROM wanted')
+			self.db.executemany('INSERT INTO wanted VALUES (?)', [(ric,) for ric in found])
+			orgRows = self.db.execute('SELECT %s FROM organizations o JOIN wanted w ON o."Instrument" = w."Instrument"' % self.columnList(ORG_COLUMNS, 'o')).fetchall()
+			segRows = self.db.execute('SELECT %s FROM segments s JOIN wanted w ON s."Instrument" = w."Instrument" ORDER BY s."Instrument", s."_seg"' % self.columnList(self.segColumns, 's')).fetchall()
+			codeRows = self.db.execute('SELECT %s FROM codes c JOIN wanted w ON c."Instrument" = w."Instrument" ORDER BY c."Instrument", c."_seg", c.rowid' % self.columnList(['Instrument'] + SEGMENT_CODE_COLUMNS, 'c')).fetchall()
+			self.db.executemany('UPDATE organizations SET accessed = ? WHERE "Instrument" = ?', [(time.time(), ric) for ric in found])
+			self.db.commit()
+
+		segments = self.readFrame(segRows, self.segColumns)
+		codes = self.readFrame(codeRows, ['Instrument'] + SEGMENT_CODE_COLUMNS)
+		# segment numbers within the instrument to row positions in the table
+		firstRows = np.flatnonzero(segments['_seg'].to_numpy() == 0)
+		firstRows = pd.Series(firstRows, index=segments['Instrument'].to_numpy()[firstRows])
+		codes['_seg'] = codes['Instrument'].map(firstRows).to_numpy() + codes['_seg'].to_numpy()
+		return self.readFrame(orgRows, ORG_COLUMNS), SegmentTable(segments.drop(columns='_seg'), codes.drop(columns='Instrument'))
+
+
+	def put(self, fingerprints, orgDF, sectorDF):
+		# results of the instruments of fingerprints {ric: fingerprint}, scored together (scorePortfolio)
+		segments = sectorDF.segments
+		# the ratio columns are missing when none of the instruments has data
+		columns = ['_seg'] + [c for c in segments.columns if c not in SEGMENT_RESULT_COLUMNS] + [c for c in SEGMENT_RESULT_COLUMNS if c not in SEGMENT_TEXT_COLUMNS]
+		segNumber = segments.groupby('Instrument', sort=False).cumcount().to_numpy()
+		segments = segments.assign(_seg=segNumber)
+		codes = sectorDF.codes.assign(_seg=segNumber[sectorDF.codes['_seg'].to_numpy()])
+		codes.insert(0, 'Instrument', segments['Instrument'].to_numpy()[sectorDF.codes['_seg'].to_numpy()])
+		orgDF = orgDF.reindex(columns=ORG_COLUMNS)
+		orgDF.insert(0, 'accessed', time.time())
+		orgDF.insert(0, 'fingerprint', orgDF['Instrument'].map(fingerprints))
+		keys = [(ric,) for ric in fingerprints]
+
+		with self.lock:
+			if set(self.segColumns) != set(columns):
+				# other fields received, the stored results are of no use
+				self.db.execute('DROP TABLE IF EXISTS segments')
+				self.db.execute('DELETE FROM organizations')
+				self.db.execute('DELETE FROM codes')
+				self.db.execute('CREATE TABLE segments (%s)' % self.columnList(columns))
+				self.db.execute('CREATE INDEX segments_instrument ON segments ("Instrument", "_seg")')
+				self.segColumns = columns
+			# the columns of a part of the portfolio can come in another order
+			segments = segments.reindex(columns=self.segColumns)
+			for table in ['segments', 'codes']:
+				self.db.executemany('DELETE FROM %s WHERE "Instrument" = ?' % table, keys)
+			for table, df in [('organizations', orgDF), ('segments', segments), ('codes', codes)]:
+				self.db.executemany('INSERT OR REPLACE INTO %s VALUES (%s)' % (table, ','.join('?' * len(df.columns))), self.sqlRows(df))
+			self.evict()
+			self.db.commit()
+
+
+	def evict(self):
+		# least recently used instruments beyond maxEntries, called with the lock held
+		if self.db.execute('SELECT COUNT(*) FROM organizations').fetchone()[0] <= self.maxEntries:
+			return
+		evicted = self.db.execute('SELECT "Instrument" FROM organizations ORDER BY accessed DESC LIMIT -1 OFFSET ?', (self.maxEntries,)).fetchall()
+		for table in ['organizations', 'segments', 'codes']:
+			self.db.executemany('DELETE FROM %s WHERE "Instrument" = ?' % table, evicted)
+
+
+	def close(self):
+		with self.lock:
+			self.db.close()
+
+
+
+#==============================================
+# fingerprint of the data each RIC is scored from: its segment and ESG rows and the database entries its codes map to
+def portfolioFingerprints(ricList, taxonMaster, esgMaster, db):
+#==============================================
+	rics = pd.Index(list(dict.fromkeys(ricList)))
+	# 64 bit sums by instrument of the hashes of its segment rows, ESG rows and database entries
+	sums = np.zeros((len(rics), 3), dtype=np.uint64)
+	def add(part, instruments, hashes):
+		positions = rics.get_indexer(instruments)
+		found = positions >= 0
+		np.add.at(sums, (positions[found], part), hashes[found])
+	entryHash = lambda entry: int.from_bytes(hashlib.sha1(repr(entry).encode('utf-8')).digest()[:8], 'little')
+
+	for part, df in enumerate([taxonMaster, esgMaster]):
+		if len(df):
+			# a row is hashed with its position in the instrument, the order of the rows counts
+			rows = df.assign(_row=df.groupby('Instrument', sort=False).cumcount())
+			add(part, df['Instrument'].to_numpy(), pd.util.hash_pandas_object(rows, index=False).to_numpy())
+
+	if len(taxonMaster) and 'Segment Code' in taxonMaster.columns:
+		# the entries of the NAICS codes of each distinct segment code
+		segCodes = taxonMaster['Segment Code'].fillna('').astype(str)
+		entries = {}
+		segHashes = {}
+		for segCode in segCodes.unique().tolist():
+			total = 0
+			for naicCode in segCode.split(','):
+				if naicCode.isnumeric():
+					if naicCode not in entries:
+						tCode = db.naicsTrbcIdx.get(naicsKey(naicCode), 0)
+						entries[naicCode] = entryHash((tCode, db.taxonIdx.get(tCode), db.metricIdx.get(tCode)))
+					total += entries[naicCode]
+			segHashes[segCode] = total % 2**64
+		add(2, taxonMaster['Instrument'].to_numpy(), np.array(segCodes.map(segHashes).tolist(), dtype=np.uint64))
+	if len(esgMaster) and 'TRBC Activity Code' in esgMaster.columns:
+		parents = esgMaster.drop_duplicates('Instrument')
+		parents = parents[parents['TRBC Activity Code'].notnull()]
+		add(2, parents['Instrument'].to_numpy(), np.array([entryHash(('parent', code, db.taxonIdx.get(code))) for code in parents['TRBC Activity Code'].tolist()], dtype=np.uint64))
+
+	# the fields received and the version of the stored results are part of every fingerprint
+	key = hashlib.sha1(repr((STATE_VERSION, list(taxonMaster.columns), list(esgMaster.columns))).encode('utf-8')).hexdigest()[:16]
+	return {ric: '%s:%016x%016x%016x' % (key, *hashes) for ric, hashes in zip(rics, sums.tolist())}
+
+
+
+# number formats and widths of the report columns
+SUMMARY_FORMATS = {'D': '0.00', 'G': '0%', 'H': '0%', 'I': '0%', 'J': '0%', 'K': '0%', 'L': '0%', 'M': '0%', 'N': '0%', 'O': '0%', 'P': '0%', 'Q': '0%'}
+SUMMARY_WIDTHS = {'A': 12, 'B': 40, 'C': 10, 'D': 12, 'E': 25, 'F': 31, 'G': 12, 'H': 12, 'I': 14, 'J': 14, 'K': 12, 'L': 12, 'M': 12, 'N': 12, 'O': 12, 'P': 12, 'Q': 12, 'R': 11, 'S': 14, 'T': 14, 'U': 12}
+SEGMENT_FORMATS = {'H': '#,##0', 'I': '0%', 'N': '0%', 'O': '0%', 'P': '0%', 'Q': '0%', 'R': '0%', 'S': '0%', 'T': '0%', 'U': '0%', 'V': '0%'}
+SEGMENT_WIDTHS = {'A': 12, 'B': 40, 'C': 10, 'D': 30, 'E': 40, 'F': 10, 'G': 10, 'H': 15, 'I': 10, 'J': 46, 'K': 24, 'L': 45, 'M': 20, 'N': 40, 'O': 10, 'P': 12, 'Q': 11, 'R': 10, 'S': 10, 'T': 12, 'U': 12, 'V': 12}
+DNSH_WIDTHS = {'A': 12, 'B': 14, 'C': 14, 'D': 14, 'E': 14, 'F': 14, 'G': 14, 'H': 14, 'I': 14, 'J': 14, 'K': 14, 'L': 14, 'M': 14, 'N': 14, 'O': 14, 'P': 14, 'Q': 14, 'R': 14, 'S': 14, 'T': 14, 'U': 14, 'V': 14, 'W': 14, 'X': 14, 'Y': 14, 'Z': 14, 'AA': 14, 'AB': 14, 'AC': 14, 'AD': 14, 'AE': 14, 'AF': 14, 'AG': 14, 'AH': 14, 'AI': 14, 'AJ': 14, 'AK': 14}
+
+# segment columns rendered from the codes of each segment by SegmentTable.render
+SEGMENT_TEXT_COLUMNS = ['TRBC Codes', 'Match with EU Taxo', 'Linked Assesment Metric', 'Metric Reported Value', 'Threshold Test']
+
+# columns of the parquet/csv tables (TableWriter) with a fixed type, the other tables take theirs from their first rows
+SUMMARY_TYPES = {**{c: 'float64' for c in ORG_COLUMNS}, **{c: 'string' for c in ['Instrument', 'Name', 'Delisted', 'Economic Sector', 'TRBC Activity', 'Parent Eligible']},
+				 'Environment Controversies': 'Int16', 'Promotes Environmental Products': 'boolean', 'Environment Red Flag': 'boolean', 'Social Controversies': 'Int32'}
+SEGMENT_CODE_TYPES = {'Instrument': 'string', 'Segment Row': 'Int64', 'TRBC Code': 'Int64', 'Match': 'string', 'Measure': 'string', 'Reported': 'float64', 'Outcome': 'string', 'Metric': 'boolean'}
+
+# columns added to the segment data by the scoring, in their report order
+SEGMENT_RESULT_COLUMNS = ['Segment Revenue Ratio', 'TRBC Codes', 'Match with EU Taxo', 'Linked Assesment Metric', 'Metric Reported Value', 'Threshold Test', 'Segment Weight', 'Aligned', 'Additional Testing Required', 'Not in Scope', 'Others', 'Aligned- Pass', 'Aligned- No Data', 'Aligned- Not in Scope']
+
+
+
+#==============================================
+# Organization Summary sheet content, the segment ratios merged with the DNSH data
+def summaryFrame(orgDF, dnshDF):
+#==============================================
+	# DNSH scores (scoreDnsh) in the order of the organizations
+	dnshDF = dnshDF.drop_duplicates('Instrument').set_index('Instrument').reindex(orgDF['Instrument']).set_axis(orgDF.index)
+	orgDF = orgDF.astype(object)
+	orgDF.fillna('', inplace=True)
+
 	summDF = orgDF[['Instrument', 'Name', 'Delisted', 'ESG Score', 'Economic Sector', 'TRBC Activity', 'Eligible', 'Not In Scope', 'Parent Eligible ratio', 'Parent Not In Scope ratio', 'Aligned by Industry', 'Aligned- Pass', 'Additional testing needed', 'Aligned- Not in Scope', 'Others']].copy()
 	sum_column = summDF["Aligned by Industry"] + summDF["Aligned- Pass"]
 	summDF.insert(11, 'Aligned Total', sum_column)
@@ -362,26 +1911,23 @@ def generateReport(rFileName, orgDF, sectorDF, dnshDF):
 					  'IF no business segment data is available is the company not in scope?', 'Aligned - By industry activity', 
 					  'Aligned - Passed Screening Criteria Threshold Test', 'Aligned Total', 'Additional testing needed', 'Eligible but not aligned (Did not pass threshold test)', 
 					  '% FROM OTHER REVENUES', 'Total Revenues %']
-	# Merge DNSH data
-	contvSum = dnshTemp['Environmental Controversies Count'] + dnshTemp['Recent Environmental Controversies']
-	contvSum[contvSum == 0] = pd.NA
-	summDF['DNSH Principle - Environment Controversies Count'] = contvSum
-	promoteSum = (dnshTemp['Environmental Products'] == 'True') | (dnshTemp['Land Environmental Impact Reduction'] == 'True') | (dnshTemp['Eco-Design Products'] == 'True')
-	summDF['Does the company promote environmentally friendly or eco-design products or land impact reduction?'] = promoteSum
-	summDF['DNSH - Environment Red Flag (Count > 0 and promotes environmentally products)'] = promoteSum & (contvSum > 0)
-	summDF['Minimum Social Safeguards - Social Controversies Count'] = dnshTemp.sum(axis=1)
-
-	summDF.replace({'Does the company promote environmentally friendly or eco-design products or land impact reduction?': {True: 'Yes', False: ''}}, inplace=True)
-	summDF.replace({'DNSH - Environment Red Flag (Count > 0 and promotes environmentally products)': {True: 'Flag', False: ''}}, inplace=True)
-	summDF.replace({'Minimum Social Safeguards - Social Controversies Count': {0: ''}}, inplace=True)
-
-	addDataFrame(ws1, summDF)
-	columnFormats(ws1, {'D': '0.00', 'G': '0%', 'H': '0%', 'I': '0%', 'J': '0%', 'K': '0%', 'L': '0%', 'M': '0%', 'N': '0%', 'O': '0%', 'P': '0%', 'Q': '0%'})
-	columnWidths(ws1, {'A': 12, 'B': 40, 'C': 10, 'D': 12, 'E': 25, 'F': 31, 'G': 12, 'H': 12, 'I': 14, 'J': 14, 'K': 12, 'L': 12, 'M': 12, 'N': 12, 'O': 12, 'P': 12, 'Q': 12, 'R': 11, 'S': 14, 'T': 14, 'U': 12})
-	ws1.freeze_panes = "B2"
+	# Merge DNSH data, counts of 0 are left blank
+	envCount = dnshDF['Environment Controversies'].astype(object)
+	summDF['DNSH Principle - Environment Controversies Count'] = envCount.where(dnshDF['Environment Controversies'].gt(0).fillna(False).astype(bool), None)
+	summDF['Does the company promote environmentally friendly or eco-design products or land impact reduction?'] = dnshDF['Promotes Environmental Products'].eq(True).map({True: 'Yes', False: ''})
+	summDF['DNSH - Environment Red Flag (Count > 0 and promotes environmentally products)'] = dnshDF['Environment Red Flag'].eq(True).map({True: 'Flag', False: ''})
+	socialCount = dnshDF['Social Controversies'].astype(object)
+	summDF['Minimum Social Safeguards - Social Controversies Count'] = socialCount.where(dnshDF['Social Controversies'].gt(0).fillna(False).astype(bool), '')
+	return summDF
 
-	# Second sheet with sector vise breakdown
-	ws3 = workbook.create_sheet("Segment Data Analysis")
+
+
+#==============================================
+# Segment Data Analysis sheet content
+def segmentFrame(sectorDF):
+#==============================================
+	sectorDF = sectorDF.astype(object)
+	sectorDF.fillna('', inplace=True)
 	sectorDF.rename(columns={'Segment Code':'NAICS 2007 code',
 							 'Delisted': 'Status',
 							 'Segment Revenue Ratio': 'Segment Revenue as a %',
@@ -394,82 +1940,650 @@ def generateReport(rFileName, orgDF, sectorDF, dnshDF):
 							 'Aligned- No Data':'Percentage Further testing needed; data not available',
 							 'Aligned- Not in Scope':'Percentage Eligible but not aligned (Did not pass threshold test)'
 							}, inplace=True)
-	addDataFrame(ws3, sectorDF)
-	columnFormats(ws3, {'H': '#,##0', 'I': '0%', 'N': '0%', 'O': '0%', 'P': '0%', 'Q': '0%', 'R': '0%', 'S': '0%', 'T': '0%', 'U': '0%', 'V': '0%'})
-	columnWidths(ws3, {'A': 12, 'B': 40, 'C': 10, 'D': 30, 'E': 40, 'F': 10, 'G': 10, 'H': 15, 'I': 10, 'J': 46, 'K': 24, 'L': 45, 'M': 20, 'N': 40, 'O': 10, 'P': 12, 'Q': 11, 'R': 10, 'S': 10, 'T': 12, 'U': 12, 'V': 12})
-	ws3.freeze_panes = "B2"
+	return sectorDF
+
+
+
+#==============================================
+# DNSH data sheet content
+def dnshFrame(dnshDF):
+#==============================================
+	# the fields as received, flags which are set read 'True'
+	dnshDF = dnshDF.drop(columns=[c for c in DNSH_SCORE_COLUMNS if c in dnshDF.columns]).astype(object)
+	for column in DNSH_FLAGS:
+		if column in dnshDF.columns:
+			dnshDF[column] = dnshDF[column].map({True: 'True', False: ''})
+	dnshDF.fillna('', inplace=True)
+	return dnshDF
+
+
+
+#==============================================
+# writes the report workbook row by row, memory use does not depend on the number of rows
+class ReportWriter:
+#==============================================
+	def __init__(self, rFileName):
+		self.fileName = rFileName
+		self.workbook = Workbook(write_only=True)
+
+		# define the spreadsheet styles
+		self.header = NamedStyle(name="header")
+		self.header.font = Font(bold=True)
+		self.header.border = Border(bottom=Side(border_style="thin"))
+		self.header.alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
+		self.workbook.add_named_style(self.header)
+
+		# widths and panes have to be set before the first row is streamed
+		self.summary = self.addSheet('Organization Summary', SUMMARY_WIDTHS, SUMMARY_FORMATS)
+		self.segments = self.addSheet('Segment Data Analysis', SEGMENT_WIDTHS, SEGMENT_FORMATS)
+		self.dnsh = self.addSheet('DNSH data', DNSH_WIDTHS, {})
+		# segment data columns, fixed by the first block written
+		self.segColumns = None
+
+
+	def addSheet(self, title, widths, formats):
+		sheet = self.workbook.create_sheet(title)
+		for ckey, cWidth in widths.items():
+			sheet.column_dimensions[ckey].width = cWidth
+		sheet.freeze_panes = "B2"
+		return {'sheet': sheet, 'formats': {column_index_from_string(ckey) - 1: cformat for ckey, cformat in formats.items()}, 'header': False}
+
+
+	def addDataFrame(self, target, sourceDF):
+		sheet = target['sheet']
+		formats = target['formats']
+		if not target['header']:
+			row = []
+			for i, name in enumerate(sourceDF.columns):
+				cell = WriteOnlyCell(sheet, value=name)
+				cell.style = self.header
+				if i in formats:
+					cell.number_format = formats[i]
+				row.append(cell)
+			sheet.append(row)
+			target['header'] = True
+
+		# styled cells only for the formatted columns
+		for values in sourceDF.itertuples(index=False, name=None):
+			row = list(values)
+			for i, cformat in formats.items():
+				if i < len(row):
+					cell = WriteOnlyCell(sheet, value=row[i])
+					cell.number_format = cformat
+					row[i] = cell
+			sheet.append(row)
+
+
+	def writeSummary(self, orgDF, dnshDF):
+		if 'Social Controversies' not in dnshDF.columns:
+			# DNSH data as received from getData
+			dnshDF = scoreDnsh(dnshDF)
+		self.addDataFrame(self.summary, summaryFrame(orgDF, dnshDF))
+
+
+	def writeSegments(self, sectorDF):
+		if isinstance(sectorDF, SegmentTable):
+			sectorDF = sectorDF.render()
+		if self.segColumns is None and len(sectorDF.columns) == 0:
+			# no segment data at all, the columns are taken from the next block
+			return
+		if self.segColumns is None:
+			# a first block of instruments without segment data has none of the scoring columns yet
+			self.segColumns = list(sectorDF.columns) + [c for c in SEGMENT_RESULT_COLUMNS if c not in sectorDF.columns]
+		self.addDataFrame(self.segments, segmentFrame(sectorDF.reindex(columns=self.segColumns)))
+
+
+	def writeDnsh(self, dnshDF):
+		if not self.dnsh['header'] and len(dnshDF) == 0:
+			# e.g. an offline block without cached data, which may not have the DNSH fields, the columns are taken from the next block
+			return
+		if 'Social Controversies' not in dnshDF.columns:
+			dnshDF = scoreDnsh(dnshDF)
+		self.addDataFrame(self.dnsh, dnshFrame(dnshDF))
+
+
+	def save(self):
+		try:
+			self.workbook.save(self.fileName)
+		except PermissionError:
+			print('Error: Unable to write report file')
+
+
+
+#==============================================
+# writes the report tables as typed parquet files or as csv, appended block by block: _summary, _segments, _segment_codes and _dnsh
+class TableWriter:
+#==============================================
+	def __init__(self, baseName, fileFormat='parquet'):
+		if fileFormat == 'parquet' and pq is None:
+			raise ImportError('Writing parquet files requires the pyarrow module')
+		self.fileName = baseName
+		self.fileFormat = fileFormat
+		# column types of each table, from the first rows written
+		self.types = {}
+		self.fileNames = {}
+		self.parquetWriters = {}
+		self.segmentRows = 0
+
+
+	def write(self, name, df, types):
+		if name not in self.types:
+			self.types[name] = types
+		df = typedFrame(df, self.types[name])
+		fileName = '%s_%s.%s' % (self.fileName, name, self.fileFormat)
+		if self.fileFormat == 'parquet':
+			if name not in self.parquetWriters:
+				schema = pa.schema([(column, pa.type_for_alias({'boolean': 'bool'}.get(t, t.lower()))) for column, t in self.types[name].items()])
+				self.parquetWriters[name] = pq.ParquetWriter(fileName, schema)
+			writer = self.parquetWriters[name]
+			writer.write_table(pa.Table.from_pandas(df, schema=writer.schema, preserve_index=False))
+		else:
+			df.to_csv(fileName, mode='a' if name in self.fileNames else 'w', header=name not in self.fileNames, index=False)
+		self.fileNames[name] = fileName
+
+
+	def writeSummary(self, orgDF, dnshDF):
+		if 'Social Controversies' not in dnshDF.columns:
+			dnshDF = scoreDnsh(dnshDF)
+		# organization ratios with the DNSH scores
+		scores = dnshDF.drop_duplicates('Instrument').set_index('Instrument').reindex(columns=DNSH_SCORE_COLUMNS).reindex(orgDF['Instrument']).set_axis(orgDF.index)
+		self.write('summary', pd.concat([orgDF.reindex(columns=ORG_COLUMNS), scores], axis=1), SUMMARY_TYPES)
+
+
+	def writeSegments(self, sectorDF):
+		segTable = sectorDF if isinstance(sectorDF, SegmentTable) else SegmentTable(sectorDF)
+		segments = segTable.segments
+		if 'segments' not in self.types:
+			if len(segments.columns) == 0:
+				return
+			columns = list(segments.columns) + [c for c in SEGMENT_RESULT_COLUMNS if c not in segments.columns and c not in SEGMENT_TEXT_COLUMNS]
+			types = {c: 'float64' if c in SEGMENT_RESULT_COLUMNS and c not in SEGMENT_TEXT_COLUMNS else columnType(segments[c]) if c in segments.columns else 'string' for c in columns}
+		else:
+			types = self.types['segments']
+		self.write('segments', segments, types)
+
+		# the codes refer to the rows of the segments table
+		codes = segTable.codes
+		self.write('segment_codes', pd.DataFrame({
+			'Instrument': segments['Instrument'].to_numpy()[codes['_seg'].to_numpy()] if len(codes) else [],
+			'Segment Row': codes['_seg'].to_numpy() + self.segmentRows,
+			'TRBC Code': codes['TRBC Code'].to_numpy(),
+			'Match': codes['Match'].to_numpy(),
+			'Measure': codes['Measure'].to_numpy(),
+			'Reported': codes['Reported'].to_numpy(),
+			'Outcome': codes['Outcome'].to_numpy(),
+			'Metric': codes['Metric'].to_numpy()
+		}), SEGMENT_CODE_TYPES)
+		self.segmentRows += len(segments)
+
+
+	def writeDnsh(self, dnshDF):
+		if 'dnsh' not in self.types and len(dnshDF) == 0:
+			return
+		if 'Social Controversies' not in dnshDF.columns:
+			dnshDF = scoreDnsh(dnshDF)
+		self.write('dnsh', dnshDF, self.types.get('dnsh') or {c: columnType(dnshDF[c]) for c in dnshDF.columns})
+
+
+	def save(self):
+		for writer in self.parquetWriters.values():
+			writer.close()
+		self.parquetWriters = {}
+
+
+
+#==============================================
+# type of a column in the parquet/csv tables
+def columnType(series):
+#==============================================
+	if pd.api.types.is_bool_dtype(series.dtype):
+		return 'boolean'
+	if pd.api.types.is_integer_dtype(series.dtype):
+		return 'Int%i' % (series.dtype.itemsize * 8)
+	if pd.api.types.is_float_dtype(series.dtype):
+		return 'float64'
+	return 'string'
+
+
+
+#==============================================
+# frame with the given columns converted to the given types (float64, IntN, boolean or string), missing columns are empty
+def typedFrame(df, types):
+#==============================================
+	df = df.reindex(columns=list(types))
+	for column, t in types.items():
+		if t == 'float64':
+			df[column] = pd.to_numeric(df[column], errors='coerce').astype('float64')
+		elif t == 'string':
+			df[column] = df[column].astype(object).astype('string')
+		else:
+			df[column] = df[column].astype(t)
+	return df.reset_index(drop=True)
+
+
+
+#==============================================
+# the report in each of the requested formats: excel workbook (ReportWriter), parquet or csv tables (TableWriter)
+class ReportOutputs:
+#==============================================
+	def __init__(self, rFileName, formats=None):
+		timestr = time.strftime("%Y%m%d-%H%M%S_")
+		self.writers = []
+		for fileFormat in dict.fromkeys(formats or ['xlsx']):
+			if fileFormat == 'xlsx':
+				self.writers.append(ReportWriter(timestr + rFileName))
+			else:
+				self.writers.append(TableWriter(timestr + os.path.splitext(rFileName)[0], fileFormat))
+		# name of the excel report, or the common prefix of the table files
+		excel = [writer for writer in self.writers if isinstance(writer, ReportWriter)]
+		self.fileName = (excel or self.writers)[0].fileName
+
+
+	def writeSummary(self, orgDF, dnshDF):
+		for writer in self.writers:
+			writer.writeSummary(orgDF, dnshDF)
+
+
+	def writeSegments(self, sectorDF):
+		for writer in self.writers:
+			writer.writeSegments(sectorDF)
+
+
+	def writeDnsh(self, dnshDF):
+		for writer in self.writers:
+			writer.writeDnsh(dnshDF)
+
+
+	def save(self):
+		for writer in self.writers:
+			writer.save()
+
+
+
+#==============================================
+def generateReport(rFileName, orgDF, sectorDF, dnshDF, formats=None):
+#==============================================
+	# sectorDF is a SegmentTable, a frame or an iterable of them (e.g. ResultCollector.segmentChunks())
+	# formats are any of xlsx (default), parquet and csv
+	writer = ReportOutputs(rFileName, formats)
+
+	# First sheet with summary data
+	writer.writeSummary(orgDF, dnshDF)
+
+	# Second sheet with sector vise breakdown
+	for chunk in ([sectorDF] if isinstance(sectorDF, (SegmentTable, pd.DataFrame)) else sectorDF):
+		writer.writeSegments(chunk)
 
 	# Third sheet with DNSH data
-	ws4 = workbook.create_sheet("DNSH data")
-	dnshDF.replace({'Strikes': {'False': ''}}, inplace=True)
-	dnshDF.replace({'Environmental Products': {'False': ''}}, inplace=True)
-	dnshDF.replace({'Land Environmental Impact Reduction': {'False': ''}}, inplace=True)
-	dnshDF.replace({'Eco-Design Products': {'False': ''}}, inplace=True)
-	addDataFrame(ws4, dnshDF)
-	columnWidths(ws4, {'A': 12, 'B': 14, 'C': 14, 'D': 14, 'E': 14, 'F': 14, 'G': 14, 'H': 14, 'I': 14, 'J': 14, 'K': 14, 'L': 14, 'M': 14, 'N': 14, 'O': 14, 'P': 14, 'Q': 14, 'R': 14, 'S': 14, 'T': 14, 'U': 14, 'V': 14, 'W': 14, 'X': 14, 'Y': 14, 'Z': 14, 'AA': 14, 'AB': 14, 'AC': 14, 'AD': 14, 'AE': 14, 'AF': 14, 'AG': 14, 'AH': 14, 'AI': 14, 'AJ': 14, 'AK': 14})
-	ws4.freeze_panes = "B2"
+	writer.writeDnsh(dnshDF)
+
+	writer.save()
+	return writer.fileName
+
+
+
+#==============================================
+# time series of the organization ratios (TaxonomyCalculator.runPeriods), as csv unless other formats are given
+def generateTimeSeries(rFileName, seriesDF, formats=None):
+#==============================================
+	timestr = time.strftime("%Y%m%d-%H%M%S_")
+	fileNames = []
+	for fileFormat in dict.fromkeys(formats or ['csv']):
+		fileName = timestr + os.path.splitext(rFileName)[0] + '_timeseries.' + fileFormat
+		try:
+			if fileFormat == 'parquet':
+				if pq is None:
+					raise ImportError('Writing parquet files requires the pyarrow module')
+				seriesDF.to_parquet(fileName, index=False)
+			elif fileFormat == 'xlsx':
+				seriesDF.to_excel(fileName, index=False)
+			else:
+				seriesDF.to_csv(fileName, index=False)
+		except PermissionError:
+			print('Error: Unable to write time series file')
+		fileNames.append(fileName)
+	return fileNames[0]
+
+
+
+#==============================================
+# portfolios of a manifest run: a csv with an input and a report column, or a json list of {"input": ..., "report": ...}
+def readManifest(mFileName):
+#==============================================
+	if os.path.splitext(mFileName)[1].lower() == '.json':
+		with open(mFileName) as f:
+			entries = json.load(f)
+	else:
+		entries = pd.read_csv(mFileName, dtype=str).to_dict('records')
+
+	portfolios = []
+	for entry in entries:
+		if not isinstance(entry.get('input'), str) or not isinstance(entry.get('report'), str):
+			raise ValueError('Manifest entry without an input or a report: %s' % entry)
+		portfolios.append((entry['input'].strip(), entry['report'].strip()))
+	reports = [report for inputFile, report in portfolios]
+	if len(set(reports)) != len(reports):
+		raise ValueError('Manifest reports must have distinct names')
+	return portfolios
+
+
+
+#==============================================
+# writes the report of each portfolio from the results of their union, several reports at a time on a process pool
+def generatePortfolioReports(portfolios, orgDF, sectorDF, dnshDF, workers=0, formats=None):
+#==============================================
+	# portfolios are (report name, RIC list), scored together in orgDF/sectorDF/dnshDF (e.g. TaxonomyCalculator.score of their union)
+	# workers 0 uses a process per CPU, returns the report names in the order of the portfolios
+	global WORKER_DATA
+	workers = min(workers or os.cpu_count() or 1, len(portfolios))
+	first = lambda instruments: {ric: i for i, ric in reversed(list(enumerate(instruments)))}
+	segRows, codeRows = sectorDF.rowsByInstrument()
+	tasks = [(rFileName, ricList, formats) for rFileName, ricList in portfolios]
+
+	with WORKER_LOCK:
+		WORKER_DATA = (orgDF, sectorDF, dnshDF, first(orgDF['Instrument']), segRows, codeRows, first(dnshDF['Instrument']))
+		try:
+			if workers <= 1:
+				return [writePortfolioReport(task) for task in tasks]
+			with workerPool(workers) as pool:
+				return pool.map(writePortfolioReport, tasks, chunksize=1)
+		finally:
+			WORKER_DATA = None
+
+
+
+#==============================================
+# worker process: report of one portfolio of a manifest run, from the results in WORKER_DATA
+def writePortfolioReport(task):
+#==============================================
+	rFileName, ricList, formats = task
+	orgDF, sectorDF, dnshDF, orgRows, segRows, codeRows, dnshRows = WORKER_DATA
+	# in offline mode the instruments without cached data were not scored
+	rics = [ric for ric in ricList if ric in orgRows]
+	empty = np.array([], dtype=np.int64)
+	portOrg = orgDF.iloc[[orgRows[ric] for ric in rics]].reset_index(drop=True)
+	portSeg = sectorDF.take(np.concatenate([empty] + [segRows[ric] for ric in rics if ric in segRows]), np.concatenate([empty] + [codeRows[ric] for ric in rics if ric in codeRows]))
+	portDnsh = dnshDF.iloc[[dnshRows[ric] for ric in rics if ric in dnshRows]].reset_index(drop=True)
 
+	# segment columns ordered after the first instrument, as when the portfolio is scored alone
+	if rics:
+		portSeg = portSeg.orderColumns(rics[0], pd.isnull(portOrg['Total'].iloc[0]))
+	return generateReport(rFileName, portOrg, portSeg, portDnsh, formats)
+
+
+
+#==============================================
+# fetch, score and write the portfolio one batch of RICs at a time
+def generatePipelinedReport(rFileName, calculator, batches, queueSize=2, formats=None):
+#==============================================
+	# batches is an iterable of RIC lists (e.g. iterInputPortfolio), the report rows follow their order
+	writer = ReportOutputs(rFileName, formats)
+	runPipeline(calculator, batches, writer, queueSize)
+	writer.save()
+	return writer.fileName
+
+
+
+#==============================================
+# fetch (thread) -> score (this thread) -> write (thread), with bounded queues between the stages
+def runPipeline(calculator, batches, writer, queueSize=2):
+#==============================================
+	# at most queueSize batches wait between two stages, so memory does not depend on the portfolio size
+	fetched = queue.Queue(maxsize=queueSize)
+	scored = queue.Queue(maxsize=queueSize)
+	stop = threading.Event()
+	errors = []
+
+	def put(q, item):
+		while not stop.is_set():
+			try:
+				q.put(item, timeout=0.1)
+				return
+			except queue.Full:
+				pass
+
+	def get(q):
+		while not stop.is_set():
+			try:
+				return q.get(timeout=0.1)
+			except queue.Empty:
+				pass
+		return None
+
+	def fetchStage():
+		try:
+			for batch in batches:
+				if stop.is_set():
+					break
+				put(fetched, calculator.fetch(batch))
+		except Exception as e:
+			errors.append(e)
+			stop.set()
+		finally:
+			put(fetched, None)
+
+	def writeStage():
+		try:
+			while True:
+				item = get(scored)
+				if item is None:
+					break
+				orgDF, sectorDF, dnshDF, results = item
+				writer.writeSummary(orgDF, dnshDF)
+				for chunk in ([sectorDF] if isinstance(sectorDF, (SegmentTable, pd.DataFrame)) else sectorDF):
+					writer.writeSegments(chunk)
+				writer.writeDnsh(dnshDF)
+				if results is not None:
+					results.close()
+		except Exception as e:
+			errors.append(e)
+			stop.set()
+
+	# with several workers every batch is scored on the same pool
+	calculator.openPool()
+	threads = [threading.Thread(target=fetchStage, daemon=True), threading.Thread(target=writeStage, daemon=True)]
+	for thread in threads:
+		thread.start()
 	try:
-		timestr = time.strftime("%Y%m%d-%H%M%S_")
-		workbook.save(timestr + rFileName)
-	except PermissionError:
-		print('Error: Unable to write report file')
+		while True:
+			item = get(fetched)
+			if item is None:
+				break
+			put(scored, calculator.scoreData(*item))
+	except Exception as e:
+		errors.append(e)
+		stop.set()
+	finally:
+		put(scored, None)
+		for thread in threads:
+			thread.join()
+		calculator.closePool()
+	if errors:
+		raise errors[0]
 
 
 
 #==============================================
-def main():
+def main(args):
 #==============================================
 	print('--------------------------------')
 	print('Portfolio - EU Taxonomy for Climate change calculator, version: 0.7')
 	print('--------------------------------')
 	
-	# initialize
-	print('Connecting to Eikon...')
-	init(args.APP_KEY)
-	print('Reading input portfolio')
-	ricList = loadInputPortfolio(args.input)
-	print('Portfolio contains [%s] instruments: %s ...' % (len(ricList), ricList[0:4]))
+	metrics = RunMetrics()
+	profiler = None
+	if args.profile:
+		tracemalloc.start()
+		profiler = cProfile.Profile()
+		profiler.enable()
+
+	# initialize, a stand-in backend module replaces the Eikon connection
+	backend = None
+	outputBase = None
+	if args.backend:
+		backend = importlib.import_module(args.backend)
+	else:
+		print('Connecting to Eikon...')
+		with metrics.stage('connect'):
+			init(args.APP_KEY)
 	
 	# load the database
-	loadDatabase('database.xlsx')
-	
+	cache = None if args.no_cache else DataCache(args.cache_file, args.cache_ttl * 3600, args.cache_size)
+	fetcher = DataFetcher(backend=backend, chunkSize=args.chunk_size, workers=args.fetch_workers, retries=args.retries, rps=args.rps, cache=cache, offline=args.offline, refresh=args.refresh)
+	state = ScoreStore(args.state) if args.state else None
+	with metrics.stage('loadDatabase'):
+		db = loadDatabase('database.xlsx', not args.no_snapshot)
+	calculator = TaxonomyCalculator(db, fetcher, args.engine, args.workers, args.spill_rows, state=state, metrics=metrics)
 	print('Mapping database loaded')
-	print('Getting Segment/ESG data for portfolio...')
-	# get data from Refinitiv
-	taxonMaster, esgMaster, dnshMaster = getData(ricList)
-	
-	print('Data received, calculating taxonomy ratios...')
-	
-	sectorDF = pd.DataFrame()
-	orgDF = pd.DataFrame(columns = ['Instrument', 'Name', 'Delisted', 'ESG Score', 'Economic Sector', 'TRBC Activity', 'Aligned by Industry', 'Additional Testing Required', 'Eligible', 'Not In Scope', 'Others', 'Aligned- Pass', 'Aligned- No Data', 'Aligned- Not in Scope', 'Additional testing needed', 'Total', 'Parent Eligible', 'Parent Eligible ratio', 'Parent Not In Scope ratio'])
-	
-	# process taxo data for each instrument in the list
-	for instr in ricList:
-		# get sub frame for this instrument
-		subDF = pd.DataFrame(taxonMaster[taxonMaster['Instrument'] == instr])
-		subDF.reset_index(inplace=True, drop=True)
-		esgData = pd.DataFrame(esgMaster[esgMaster['Instrument'] == instr])
-		esgData.reset_index(inplace=True, drop=True)
-		report, msubDF = getTaxoForRic(instr, subDF, esgData)
-		# append data to the aggregate data frame
-		sectorDF = sectorDF.append(msubDF, ignore_index=True)
-		orgDF = orgDF.append(report, ignore_index=True)
-	
-	print('Generating report')
-	generateReport(args.report, orgDF, sectorDF, dnshMaster)
+
+	if args.serve:
+		serve(calculator, args.serve, args.host)
+		calculator.close()
+		return
+
+	if args.pipeline:
+		# batches of the portfolio are fetched, scored and written while the next ones are read
+		print('Reading, scoring and writing the portfolio in batches of [%s] instruments...' % args.batch_size)
+		with metrics.stage('pipeline'):
+			reportName = generatePipelinedReport(args.report, calculator, iterInputPortfolio(args.input, args.batch_size), args.queue_size, args.format)
+		calculator.close()
+		print('Portfolio contained [%s] instruments' % metrics.instruments)
+	elif args.manifest:
+		# one fetch and one scoring of the union of the portfolios, then a report per portfolio
+		portfolios = readManifest(args.manifest)
+		print('Reading [%s] input portfolios' % len(portfolios))
+		with metrics.stage('loadInputPortfolio'):
+			ricLists = [loadInputPortfolio(inputFile) for inputFile, report in portfolios]
+		ricList = list(dict.fromkeys(ric for rics in ricLists for ric in rics))
+		print('Portfolios contain [%s] instruments, [%s] distinct: %s ...' % (sum(len(rics) for rics in ricLists), len(ricList), ricList[0:4]))
+
+		print('Getting Segment/ESG data for the portfolios and calculating taxonomy ratios...')
+		orgDF, sectorDF, dnshDF = calculator.score(ricList)
+		calculator.close()
+
+		print('Generating [%s] reports' % len(portfolios))
+		with metrics.stage('generateReport'):
+			reportName = generatePortfolioReports([(report, rics) for (inputFile, report), rics in zip(portfolios, ricLists)], orgDF, sectorDF, dnshDF, args.report_workers, args.format)
+		outputBase = time.strftime("%Y%m%d-%H%M%S_") + os.path.splitext(os.path.basename(args.manifest))[0]
+	elif args.periods or args.date_range:
+		periods = expandPeriods(args.periods, args.date_range)
+		print('Reading input portfolio')
+		with metrics.stage('loadInputPortfolio'):
+			ricList = loadInputPortfolio(args.input)
+		print('Portfolio contains [%s] instruments: %s ...' % (len(ricList), ricList[0:4]))
+
+		print('Getting Segment/ESG data and calculating taxonomy ratios for [%s] periods: %s ...' % (len(periods), periods[0:4]))
+		seriesDF = calculator.runPeriods(ricList, periods)
+		calculator.close()
+
+		print('Writing time series')
+		with metrics.stage('generateTimeSeries'):
+			reportName = generateTimeSeries(args.report, seriesDF, args.format)
+	else:
+		print('Reading input portfolio')
+		with metrics.stage('loadInputPortfolio'):
+			ricList = loadInputPortfolio(args.input)
+		print('Portfolio contains [%s] instruments: %s ...' % (len(ricList), ricList[0:4]))
+		
+		print('Getting Segment/ESG data for portfolio and calculating taxonomy ratios...')
+		# get data from Refinitiv and process it
+		orgDF, sectorDF, dnshMaster, results = calculator.run(ricList)
+		calculator.close()
+		
+		print('Generating report')
+		with metrics.stage('generateReport'):
+			reportName = generateReport(args.report, orgDF, sectorDF, dnshMaster, args.format)
+		if results is not None:
+			results.close()
+	if fetcher.errors:
+		print('%i data request(s) reported errors, see the warnings above' % len(fetcher.errors))
+
+	# run metrics (and profile) next to the report, next to the manifest reports for a manifest run
+	if outputBase is None:
+		outputBase = os.path.splitext(reportName)[0]
+	extra = {'report': reportName, 'engine': args.engine, 'workers': args.workers}
+	if profiler is not None:
+		profiler.disable()
+		profiler.dump_stats(outputBase + '_profile.prof')
+		extra['peakMemoryMB'] = round(tracemalloc.get_traced_memory()[1] / 2**20, 2)
+		writeMemoryProfile(outputBase + '_memory.txt', tracemalloc.take_snapshot())
+		tracemalloc.stop()
+	metrics.write(outputBase + '_metrics.json', extra)
+	print('Stage times: %s' % ', '.join('%s %.2fs' % (name, sec) for name, sec in metrics.stages.items()))
+
+
+
+#==============================================
+# top allocations of a tracemalloc snapshot
+def writeMemoryProfile(fileName, snapshot, limit=30):
+#==============================================
+	try:
+		with open(fileName, 'w') as f:
+			f.write('Peak traced memory: %.1f MB\n\n' % (tracemalloc.get_traced_memory()[1] / 2**20))
+			for stat in snapshot.statistics('lineno')[:limit]:
+				f.write('%s\n' % stat)
+	except OSError as e:
+		print('Warning: Unable to write the memory profile: %s' % e)
+
+
+
+#==============================================
+# command line arguments
+def buildParser():
+#==============================================
+	parser = ArgumentParser()
+	parser.add_argument('APP_KEY', nargs='?', help='Eikon AppKey. See the install readme help on how to generate one')
+	parser.add_argument('-i', '--input', default='input.xlsx', help='Portfolio file (excel, csv or parquet) containing the list of securities with a \'RIC\' column-header')
+	parser.add_argument('-r', '--report', default='report.xlsx', help='Output report excel filename')
+	parser.add_argument('--format', action='append', choices=['xlsx', 'parquet', 'csv'], help='Output format, repeat for several: the excel report (default) and/or the report tables as parquet (requires pyarrow) or csv files')
+	parser.add_argument('-e', '--engine', default='batch', choices=['batch', 'ric'], help='Scoring engine: whole portfolio at once (batch) or one instrument at a time (ric)')
+	parser.add_argument('--chunk-size', type=int, default=500, help='Number of instruments per Eikon request')
+	parser.add_argument('--fetch-workers', type=int, default=3, help='Number of concurrent Eikon requests')
+	parser.add_argument('--retries', type=int, default=3, help='Number of retries for a failed Eikon request')
+	parser.add_argument('--rps', type=float, default=5, help='Maximum number of Eikon requests per second, 0 for no limit')
+	parser.add_argument('--cache-file', default='taxo_cache.db', help='SQLite file caching the Eikon responses')
+	parser.add_argument('--no-cache', action='store_true', help='Do not read or write the response cache')
+	parser.add_argument('--cache-ttl', type=float, default=24, help='Hours after which a cached response expires')
+	parser.add_argument('--cache-size', type=int, default=100000, help='Maximum number of cached responses (one per instrument and field group)')
+	parser.add_argument('--offline', action='store_true', help='Only use cached data, expired entries included, do not request anything from Eikon')
+	parser.add_argument('--refresh', action='store_true', help='Ignore cached data, request everything from Eikon and update the cache')
+	parser.add_argument('--no-snapshot', action='store_true', help='Always parse database.xlsx, do not read or write its compiled snapshot')
+	parser.add_argument('-w', '--workers', type=int, default=1, help='Number of processes scoring the portfolio')
+	parser.add_argument('--spill-rows', type=int, default=0, help='ric engine or workers: move segment results to a temporary file every N rows to bound memory, 0 keeps everything in memory')
+	parser.add_argument('--state', metavar='FILE', help='SQLite file keeping the per instrument results, instruments whose data and database entries did not change are not scored again')
+	parser.add_argument('--pipeline', action='store_true', help='Fetch, score and write the portfolio in batches, fetching the next batch while the current one is scored')
+	parser.add_argument('--batch-size', type=int, default=1000, help='pipeline: number of instruments per batch')
+	parser.add_argument('--queue-size', type=int, default=2, help='pipeline: number of batches waiting between two stages, bounds the memory use')
+	parser.add_argument('--manifest', metavar='FILE', help='csv (input,report columns) or json list of portfolios: the union of their instruments is fetched and scored once, then each portfolio gets its report')
+	parser.add_argument('--report-workers', type=int, default=0, help='manifest: number of processes writing the reports, 0 for one per CPU')
+	parser.add_argument('--periods', help='Comma separated fiscal periods (e.g. FY2019,FY2020 or FY0,FY-1) to score, writes a time series of the organization ratios instead of the report')
+	parser.add_argument('--date-range', metavar='START:END', help='As-of dates to score, yearly from START to END (e.g. 2019-12-31:2021-12-31), writes a time series like --periods')
+	parser.add_argument('--profile', action='store_true', help='Write a cProfile (_profile.prof) and a tracemalloc (_memory.txt) profile of the run next to the report, the batch engine has no per instrument times but the profile shows its time per function')
+	parser.add_argument('--serve', type=int, metavar='PORT', help='Keep the database loaded and serve scoring requests as HTTP/JSON on this port instead of writing a report')
+	parser.add_argument('--host', default='127.0.0.1', help='Address the service listens on')
+	parser.add_argument('--backend', metavar='MODULE', help='Module with an eikon style get_data(instruments, fields) used instead of Eikon, e.g. a local stand-in')
+	return parser
+
 
 	
 #==============================================
 if __name__ == "__main__":
 #==============================================
 	# read input arguments
-	parser = ArgumentParser()
-	parser.add_argument('APP_KEY', help='Eikon AppKey. See the install readme help on how to generate one')
-	parser.add_argument('-i', '--input', default='input.xlsx', help='Excel portfolio file containing the list of securities with a \'RIC\' column-header')
-	parser.add_argument('-r', '--report', default='report.xlsx', help='Output report excel filename')
+	parser = buildParser()
 	args = parser.parse_args()
+	if args.APP_KEY is None and args.backend is None:
+		parser.error('the APP_KEY is required unless a --backend is given')
+	if (args.periods or args.date_range) and (args.pipeline or args.serve):
+		parser.error('--periods and --date-range cannot be combined with --pipeline or --serve')
+	if args.periods or args.date_range:
+		try:
+			expandPeriods(args.periods, args.date_range)
+		except ValueError as e:
+			parser.error(str(e))
+	if args.manifest and (args.pipeline or args.serve or args.periods or args.date_range):
+		parser.error('--manifest cannot be combined with --pipeline, --serve, --periods or --date-range')
 
 	# start processing
-	main()
+	main(args)
 	
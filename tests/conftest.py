@@ -0,0 +1,80 @@
+# Shared fixtures of the taxonomy tests: a tiny mapping database and eikon style frames
+import os
+import sys
+import numpy as np
+import pandas as pd
+import pytest
+from openpyxl import Workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import taxo
+
+# NAICS>TRBC rows: 33333 (5 digits) is padded to 333330, 221110 is listed twice (first row wins), 999990 is not mapped
+NAICS_ROWS = [(111110, 5010101010), (221110, 5020202020), (221110, 5099999999), (333330, 5030303030), (444440, 5040404040), (555550, 5050505050)]
+# EU Taxonomy rows: 5040404040 and the unmapped code 0 are not in the taxonomy ('na'), 5020202020 is listed twice
+TAXON_ROWS = [(5010101010, 'No'), (5020202020, 'Yes'), (5020202020, 'No'), (5030303030, 'Yes'), (5050505050, 'Yes')]
+# Testing Metrics rows: 5020202020 is listed twice
+METRIC_ROWS = [(5020202020, 'CO2 Intensity', 'TR.CO2Intensity', 50), (5020202020, 'Water Use', 'TR.WaterUse', 10), (5030303030, 'Water Use', 'TR.WaterUse', 5), (5050505050, 'Water Use', 'TR.WaterUse', 20)]
+
+SEGMENT_COLUMNS = ['Instrument', 'Segment Code', 'Segment Name', 'Financial Period Absolute', 'Currency', 'Business Total Revenues (Calculated)']
+ESG_COLUMNS = ['Instrument', 'CO2 Intensity', 'Water Use', 'Company Common Name', 'ESG Score', 'TRBC Activity Code', 'TRBC Economic Sector Name', 'TRBC Activity Name']
+
+
+
+#==============================================
+# database.xlsx with the rows above, compiled the way loadDatabase does
+@pytest.fixture
+def db(tmp_path):
+#==============================================
+	workbook = Workbook(write_only=True)
+	sheet = workbook.create_sheet('NAICS>TRBC')
+	sheet.append(['NAICS Code', 'NAICS Title', 'TRBC Hierarchical Code'])
+	for naics, trbc in NAICS_ROWS:
+		sheet.append([naics, 'NAICS activity %i' % naics, trbc])
+
+	sheet = workbook.create_sheet('EU Taxonomy')
+	sheet.append(['TRBC code', 'TRBC Activity', 'Additional testing needed?'])
+	for trbc, needed in TAXON_ROWS:
+		sheet.append([trbc, 'TRBC activity %i' % trbc, needed])
+
+	sheet = workbook.create_sheet('Testing Metrics')
+	sheet.append(['TRBC Activity', 'Refinitiv ESG Data Measures', 'Refinitiv ESG Field', 'Used for testing'])
+	for row in METRIC_ROWS:
+		sheet.append(list(row))
+
+	dbFileName = str(tmp_path / 'database.xlsx')
+	workbook.save(dbFileName)
+	return taxo.openDatabase(dbFileName, useSnapshot=False)
+
+
+
+#==============================================
+# segment rows of one instrument: (segment code, revenue) pairs, the SEGMTL total is added
+def segmentRows(ric, segments, total=True):
+#==============================================
+	rows = [(ric, code, 'Segment %i' % i, 'FY2021', 'USD', revenue) for i, (code, revenue) in enumerate(segments)]
+	if total:
+		rows.append((ric, 'SEGMTL', 'Segment Total', 'FY2021', 'USD', sum(revenue for code, revenue in segments)))
+	return rows
+
+
+
+#==============================================
+# ESG row of one instrument
+def esgRow(ric, co2=np.nan, water=np.nan, parentCode=np.nan):
+#==============================================
+	return (ric, co2, water, 'Company %s' % ric, 42.5, parentCode, 'Sector', 'Activity')
+
+
+
+#==============================================
+def segmentFrame(rows):
+#==============================================
+	return pd.DataFrame(rows, columns=SEGMENT_COLUMNS)
+
+
+
+#==============================================
+def esgFrame(rows):
+#==============================================
+	return pd.DataFrame(rows, columns=ESG_COLUMNS)
@@ -0,0 +1,102 @@
+# Eikon requests: failed chunks, cached responses and offline runs
+import pandas as pd
+import pytest
+import taxo
+from conftest import segmentRows, esgRow, segmentFrame, esgFrame
+
+RICS = ['AAA.N', 'BBB.N', 'CCC.N', 'DDD.N', 'EEE.N']
+
+
+
+#==============================================
+# eikon style backend answering from fixed frames, requests including a failing RIC raise
+class FakeBackend:
+#==============================================
+	def __init__(self, failing=(), failingFields=None):
+		self.failing = set(failing)
+		self.failingFields = failingFields
+		self.calls = 0
+		self.frames = {
+			'Segment': segmentFrame([row for ric in RICS for row in segmentRows(ric, [('111110', 60.), ('221110', 40.)])]),
+			'ESG': esgFrame([esgRow(ric, co2=30., parentCode=5010101010) for ric in RICS]),
+			'DNSH': pd.DataFrame([(ric, 1, 'True') for ric in RICS], columns=['Instrument', 'Environmental Controversies Count', 'Strikes'])
+		}
+
+
+	def get_data(self, instruments, fields, parameters=None):
+		self.calls += 1
+		group = 'Segment' if fields == taxo.SEGMENT_FIELDS else 'DNSH' if fields == taxo.DNSH_FIELDS else 'ESG'
+		if self.failing & set(instruments) and self.failingFields in (None, group):
+			raise ConnectionError('request timed out')
+		frame = self.frames[group]
+		return frame[frame['Instrument'].isin(instruments)].reset_index(drop=True), None
+
+
+
+#==============================================
+def makeCalculator(db, backend, cache=None, offline=False, engine='batch'):
+#==============================================
+	fetcher = taxo.DataFetcher(backend=backend, chunkSize=2, workers=2, retries=1, backoff=0, rps=0, cache=cache, offline=offline)
+	return taxo.TaxonomyCalculator(db, fetcher, engine)
+
+
+
+#==============================================
+@pytest.mark.parametrize('engine', ['batch', 'ric'])
+def testFailedChunkIsNotScored(db, tmp_path, engine):
+#==============================================
+	cache = taxo.DataCache(str(tmp_path / 'cache.db'))
+	calculator = makeCalculator(db, FakeBackend(failing=['CCC.N'], failingFields='Segment'), cache, engine=engine)
+	with pytest.raises(RuntimeError, match=r'Segment data request\(s\) failed after 1 retries for \[2\] instruments'):
+		calculator.score(RICS)
+
+	# the chunks received are cached, only the failed one is missing
+	frames, missing = cache.get(RICS, taxo.SEGMENT_FIELDS)
+	assert missing == ['CCC.N', 'DDD.N']
+	cache.close()
+
+
+#==============================================
+def testOfflineWithoutCachedData(db, tmp_path):
+#==============================================
+	backend = FakeBackend()
+	calculator = makeCalculator(db, backend, taxo.DataCache(str(tmp_path / 'cache.db')), offline=True)
+	orgDF, sectorDF, dnshDF = calculator.score(RICS)
+	assert backend.calls == 0
+	assert len(orgDF) == 0 and list(orgDF.columns) == taxo.ORG_COLUMNS
+	assert len(sectorDF) == 0 and len(dnshDF) == 0
+	calculator.close()
+
+
+#==============================================
+def testOfflineSkipsInstrumentsWithoutCachedData(db, tmp_path):
+#==============================================
+	cache = taxo.DataCache(str(tmp_path / 'cache.db'))
+	online = makeCalculator(db, FakeBackend(), cache)
+	expectedOrg, expectedSeg, expectedDnsh = online.score(['BBB.N', 'DDD.N'])
+
+	backend = FakeBackend()
+	calculator = makeCalculator(db, backend, cache, offline=True)
+	orgDF, sectorDF, dnshDF = calculator.score(RICS)
+	assert backend.calls == 0
+	pd.testing.assert_frame_equal(orgDF, expectedOrg)
+	pd.testing.assert_frame_equal(sectorDF.render(), expectedSeg.render())
+	calculator.close()
+
+
+#==============================================
+def testOfflineKeepsExpiredData(db, tmp_path):
+#==============================================
+	cacheFile = str(tmp_path / 'cache.db')
+	online = makeCalculator(db, FakeBackend(), taxo.DataCache(cacheFile))
+	expectedOrg, expectedSeg, expectedDnsh = online.score(RICS)
+	online.close()
+
+	# every entry is older than the ttl
+	cache = taxo.DataCache(cacheFile, ttl=0)
+	calculator = makeCalculator(db, FakeBackend(), cache, offline=True)
+	orgDF, sectorDF, dnshDF = calculator.score(RICS)
+	pd.testing.assert_frame_equal(orgDF, expectedOrg)
+	frames, missing = cache.get(RICS, taxo.SEGMENT_FIELDS, expired=True)
+	assert missing == []
+	calculator.close()
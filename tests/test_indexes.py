@@ -0,0 +1,80 @@
+# The dict indexes of the database must give the same lookups as the scans of the database tables they replaced
+import numpy as np
+import taxo
+from conftest import segmentRows, esgRow, segmentFrame, esgFrame
+
+
+
+#==============================================
+# TRBC code, EU taxonomy match, metric (measure, threshold) of a NAICS code by scanning the tables, first matching row wins
+def scanLookups(db, naicCode):
+#==============================================
+	if len(naicCode) < 6:
+		naicCode = naicCode + '0'
+	trbMatch = db.trbc[db.trbc['NAICS Code'] == int(naicCode)]
+	tCode = 0 if trbMatch.empty else trbMatch.iloc[0]['TRBC Hierarchical Code']
+
+	txnMatch = db.taxon[db.taxon['TRBC code'] == tCode]
+	match = 'na' if txnMatch.empty else txnMatch.iloc[0]['Additional testing needed?']
+
+	metMatch = db.testingMetrics[db.testingMetrics['TRBC Activity'] == tCode]
+	metric = None if metMatch.empty else (metMatch.iloc[0]['Refinitiv ESG Data Measures'], metMatch.iloc[0]['Used for testing'])
+	return tCode, match, metric
+
+
+
+#==============================================
+def testIndexesMatchTableScans(db):
+#==============================================
+	# every key of the tables, a duplicated key and codes which are not in the tables
+	for naicCode in ['111110', '221110', '33333', '333330', '444440', '555550', '999990', '12345']:
+		tCode, match, metric = scanLookups(db, naicCode)
+		assert db.naicsTrbcIdx.get(taxo.naicsKey(naicCode), 0) == tCode
+		assert db.taxonIdx.get(tCode, 'na') == match
+		indexed = db.metricIdx.get(tCode)
+		assert (None if indexed is None else (indexed[0], indexed[2])) == metric
+
+
+#==============================================
+def testFirstRowWinsAndPadding(db):
+#==============================================
+	assert db.naicsTrbcIdx[taxo.naicsKey('221110')] == 5020202020
+	assert db.naicsTrbcIdx[taxo.naicsKey('33333')] == 5030303030
+	assert db.taxonIdx[5020202020] == 'Yes'
+	assert db.metricIdx[5020202020] == ('CO2 Intensity', 'TR.CO2Intensity', 50)
+	assert db.naicsTrbcIdx.get(taxo.naicsKey('999990'), 0) == 0
+	assert db.taxonIdx.get(0, 'na') == 'na'
+
+
+#==============================================
+def testGetTaxoForRicMatchesTableScans(db):
+#==============================================
+	segments = [('111110', 100.), ('221110,33333', 300.), ('999990', 50.), ('OTHADJ', 25.), ('555550,444440', 200.)]
+	buisData = segmentFrame(segmentRows('AAA.N', segments))
+	esgData = esgFrame([esgRow('AAA.N', co2=40., water=np.nan)])
+	aggD, segTable = taxo.getTaxoForRic('AAA.N', buisData, esgData, db)
+	sectorDF = segTable.render()
+	assert len(sectorDF) == len(segments)
+
+	ratios = {'No': 0., 'Yes': 0., 'na': 0.}
+	for seg, (segCode, revenue) in enumerate(segments):
+		codes = segTable.codes[segTable.codes['_seg'] == seg]
+		lookups = [scanLookups(db, c) for c in segCode.split(',') if c.isnumeric()]
+		assert codes['TRBC Code'].tolist() == [tCode for tCode, match, metric in lookups]
+		assert codes['Match'].astype(str).tolist() == [match for tCode, match, metric in lookups]
+		assert codes['Measure'].astype(str).tolist() == ['' if metric is None else metric[0] for tCode, match, metric in lookups]
+		assert codes['Metric'].tolist() == [metric is not None for tCode, match, metric in lookups]
+		outcomes = [taxo.thresholdResult(esgData[metric[0]][0], metric[1]) if metric is not None else '' for tCode, match, metric in lookups]
+		assert codes['Outcome'].astype(str).tolist() == outcomes
+
+		row = sectorDF.iloc[seg]
+		assert row['TRBC Codes'] == ', '.join(str(tCode) for tCode, match, metric in lookups)
+		assert row['Match with EU Taxo'] == ', '.join(match for tCode, match, metric in lookups)
+		segRev = revenue / 675. / len(segCode.split(','))
+		for match, total in ratios.items():
+			ratios[match] = total + segRev * [m for t, m, x in lookups].count(match)
+
+	assert abs(aggD['Aligned by Industry'] - ratios['No']) < 1e-12
+	assert abs(aggD['Additional Testing Required'] - ratios['Yes']) < 1e-12
+	assert abs(aggD['Not In Scope'] - ratios['na']) < 1e-12
+	assert abs(aggD['Others'] - 25. / 675.) < 1e-12
@@ -0,0 +1,29 @@
+# Run metrics stay bounded over a long running service
+import json
+import pandas as pd
+import taxo
+
+
+
+#==============================================
+def testRecentCallsAndTimesAreBounded():
+#==============================================
+	metrics = taxo.RunMetrics(recentCalls=5, recentTimes=10)
+	df = pd.DataFrame({'Instrument': ['AAA.N', 'BBB.N']})
+	for i in range(20):
+		metrics.addCall('Segment', 2, 0.5, df, 'field not found' if i == 0 else None)
+		metrics.addRics([0.001 * (i + 1)] * 3)
+	metrics.addInstruments(60, reused=4)
+
+	summary = metrics.summary()
+	assert len(summary['eikon']['requests']) == 5
+	group = summary['eikon']['groups']['Segment']
+	assert group['bytes'] > 0
+	assert {k: v for k, v in group.items() if k != 'bytes'} == {'calls': 20, 'errors': 1, 'instruments': 40, 'rows': 40, 'seconds': 10.0, 'maxSeconds': 0.5}
+	assert len(metrics.ricTimes) == 10
+	assert summary['scoring']['timedInstruments'] == 60
+	assert sum(summary['scoring']['histogram'].values()) == 60
+	assert summary['scoring']['maxMs'] == 20.0
+	assert summary['scoring']['p50Ms'] == 19.0
+	assert (summary['instruments'], summary['reused']) == (60, 4)
+	json.dumps(summary)
@@ -0,0 +1,19 @@
+# Fiscal periods and as-of dates scored in one run
+import pytest
+import taxo
+
+
+
+#==============================================
+def testExpandPeriods():
+#==============================================
+	assert taxo.expandPeriods('FY2020, FY2021,FY2020') == ['FY2020', 'FY2021']
+	assert taxo.expandPeriods('FY0', '2019-12-31:2021-06-30') == ['FY0', '2019-12-31', '2020-12-31']
+
+
+#==============================================
+@pytest.mark.parametrize('periods, dateRange', [(',', None), (None, '2021-12-31:2019-12-31'), (None, '2019-12-31')])
+def testExpandPeriodsWithoutPeriods(periods, dateRange):
+#==============================================
+	with pytest.raises(ValueError):
+		taxo.expandPeriods(periods, dateRange)
@@ -0,0 +1,77 @@
+# The batch engine (scorePortfolio) must give the same results as the per RIC engine (scoreRics + ResultCollector)
+import numpy as np
+import pandas as pd
+import pytest
+import taxo
+from conftest import segmentRows, esgRow, segmentFrame, esgFrame
+
+
+
+#==============================================
+# segment and ESG data of the test portfolio, with the cases the batch engine handles apart
+def portfolioData():
+#==============================================
+	segments = segmentRows('AAA.N', [('111110', 100.), ('221110,33333', 300.), ('999990', 50.), ('OTHADJ', 25.), ('555550,444440', 200.)])
+	# eliminations after the total, excluded like the total
+	segments.append(('AAA.N', 'ICELIM', 'Eliminations', 'FY2021', 'USD', -20.))
+	# delisted instrument
+	segments += segmentRows('DEL.N^L21', [('333330', 40.), ('221110', 60.)])
+	# no revenues reported
+	segments.append(('NOREV.N', None, None, None, None, np.nan))
+	# revenues below 10
+	segments += segmentRows('SMALL.N', [('111110', 4.), ('555550', 3.)])
+	segments.append(('NOPARENT.N', None, None, None, None, np.nan))
+	segments += segmentRows('BBB.N', [('555550', 80.), ('444440,111110', 20.)])
+	# total before the business segments
+	totalFirst = segmentRows('TOT.N', [('333330', 70.), ('999990', 30.)])
+	segments += totalFirst[-1:] + totalFirst[:-1]
+
+	esg = [
+		esgRow('AAA.N', co2=40., water=np.nan, parentCode=5010101010),
+		esgRow('DEL.N^L21', co2=60., water=2., parentCode=5020202020),
+		esgRow('NOREV.N', parentCode=5010101010),
+		esgRow('SMALL.N', co2=1., parentCode=5040404040),
+		esgRow('NOPARENT.N'),
+		esgRow('BBB.N', co2=0., water=30.),
+		esgRow('TOT.N', water=3., parentCode=5030303030)
+	]
+	return segmentFrame(segments), esgFrame(esg)
+
+
+
+#==============================================
+@pytest.mark.parametrize('ricList', [
+	['AAA.N', 'DEL.N^L21', 'NOREV.N', 'TOT.N', 'SMALL.N', 'AAA.N', 'NOPARENT.N', 'BBB.N'],
+	# the segment columns follow the first instrument, here one without data
+	['NOREV.N', 'BBB.N', 'SMALL.N', 'DEL.N^L21', 'BBB.N', 'AAA.N', 'TOT.N', 'NOPARENT.N']
+])
+def testScorePortfolioMatchesScoreRics(db, ricList):
+#==============================================
+	taxonMaster, esgMaster = portfolioData()
+
+	results = taxo.ResultCollector()
+	taxo.scoreRics(ricList, taxonMaster, esgMaster, results, db=db)
+	expectedOrg, expectedSeg = results.organizations(), results.segments()
+
+	orgDF, sectorDF = taxo.scorePortfolio(ricList, taxonMaster, esgMaster, db)
+
+	pd.testing.assert_frame_equal(orgDF, expectedOrg, check_dtype=False)
+	pd.testing.assert_frame_equal(sectorDF.render(), expectedSeg.render(), check_dtype=False)
+	pd.testing.assert_frame_equal(sectorDF.codes, expectedSeg.codes)
+
+
+
+#==============================================
+# no instrument has segment data, the codes table is empty
+def testScorePortfolioWithoutSegmentData(db):
+#==============================================
+	taxonMaster, esgMaster = portfolioData()
+	ricList = ['NOREV.N', 'NOPARENT.N']
+
+	results = taxo.ResultCollector()
+	taxo.scoreRics(ricList, taxonMaster, esgMaster, results, db=db)
+	orgDF, sectorDF = taxo.scorePortfolio(ricList, taxonMaster, esgMaster, db)
+
+	assert len(sectorDF.codes) == 0
+	expectedSeg = results.segments().render()
+	pd.testing.assert_frame_equal(sectorDF.render()[expectedSeg.columns], expectedSeg, check_dtype=False)
@@ -0,0 +1,82 @@
+# Incremental scoring (--state): the instruments whose data did not change are reused and give the same results as a full scoring
+import pandas as pd
+import taxo
+from test_scoring import portfolioData
+
+RIC_LIST = ['AAA.N', 'DEL.N^L21', 'NOREV.N', 'TOT.N', 'SMALL.N', 'AAA.N', 'NOPARENT.N', 'BBB.N']
+
+
+
+#==============================================
+# orgDF and SegmentTable of the portfolio, with the stored results when store is given
+def score(db, ricList, taxonMaster, esgMaster, store=None):
+#==============================================
+	calculator = taxo.TaxonomyCalculator(db, state=store)
+	orgDF, sectorDF, dnshMaster, results = calculator.scoreFrames(ricList, taxonMaster, esgMaster, pd.DataFrame())
+	return calculator.reused, orgDF, sectorDF
+
+
+
+#==============================================
+def assertSameResults(got, expected):
+#==============================================
+	pd.testing.assert_frame_equal(got[1], expected[1], check_dtype=False)
+	pd.testing.assert_frame_equal(got[2].render(), expected[2].render(), check_dtype=False)
+
+
+
+#==============================================
+def testRerunReusesEveryInstrument(db, tmp_path):
+#==============================================
+	taxonMaster, esgMaster = portfolioData()
+	expected = score(db, RIC_LIST, taxonMaster, esgMaster)
+	store = taxo.ScoreStore(str(tmp_path / 'state.db'))
+
+	first = score(db, RIC_LIST, taxonMaster, esgMaster, store)
+	assert first[0] == 0
+	assertSameResults(first, expected)
+
+	rerun = score(db, RIC_LIST, taxonMaster, esgMaster, store)
+	assert rerun[0] == len(set(RIC_LIST))
+	assertSameResults(rerun, expected)
+	store.close()
+
+	# the results are read back from the file
+	store = taxo.ScoreStore(str(tmp_path / 'state.db'))
+	assertSameResults(score(db, RIC_LIST[::-1], taxonMaster, esgMaster, store), score(db, RIC_LIST[::-1], taxonMaster, esgMaster))
+	store.close()
+
+
+
+#==============================================
+def testChangedInstrumentIsScoredAgain(db, tmp_path):
+#==============================================
+	taxonMaster, esgMaster = portfolioData()
+	store = taxo.ScoreStore(str(tmp_path / 'state.db'))
+	score(db, RIC_LIST, taxonMaster, esgMaster, store)
+
+	taxonMaster.loc[taxonMaster['Instrument'] == 'BBB.N', 'Business Total Revenues (Calculated)'] *= 2
+	esgMaster.loc[esgMaster['Instrument'] == 'SMALL.N', 'CO2 Intensity'] = 80.
+	rerun = score(db, RIC_LIST, taxonMaster, esgMaster, store)
+	assert rerun[0] == len(set(RIC_LIST)) - 2
+	assertSameResults(rerun, score(db, RIC_LIST, taxonMaster, esgMaster))
+
+	# the changed instruments are stored with their new data
+	assert score(db, RIC_LIST, taxonMaster, esgMaster, store)[0] == len(set(RIC_LIST))
+	store.close()
+
+
+
+#==============================================
+# the least recently used instruments beyond maxEntries are dropped
+def testStoreKeepsMaxEntries(db, tmp_path):
+#==============================================
+	taxonMaster, esgMaster = portfolioData()
+	store = taxo.ScoreStore(str(tmp_path / 'state.db'), maxEntries=3)
+	score(db, ['AAA.N', 'BBB.N', 'TOT.N'], taxonMaster, esgMaster, store)
+	score(db, ['SMALL.N', 'DEL.N^L21'], taxonMaster, esgMaster, store)
+
+	assert score(db, ['SMALL.N', 'DEL.N^L21'], taxonMaster, esgMaster, store)[0] == 2
+	assert store.db.execute('SELECT COUNT(*) FROM organizations').fetchone()[0] == 3
+	assert store.db.execute('SELECT COUNT(DISTINCT "Instrument") FROM segments').fetchone()[0] == 3
+	store.close()